@@ -66,7 +66,7 @@ class SQL():
     def update_course_invites(self, pending_invites):
         cur = self.cursor()
         q1 = """SELECT invitation_Id FROM oimr_invitations WHERE invitation_Status = 'SENT'"""
-        q2 = """UPDATE oimr_invitations SET invitatation_status = 'ACCEPTED' WHERE invitation_Id = %s"""
+        q2 = """UPDATE oimr_invitations SET invitation_status = 'ACCEPTED' WHERE invitation_Id = %s"""
 
         try:
             cur.execute(q1)
@@ -75,6 +75,7 @@ class SQL():
             result = None
         
         if result:
+            pending_invites = set(pending_invites)
             accepted = [(i,) for i in result if i not in pending_invites]
             cur.executemany(q2, accepted)
             self.conn.commit()
@@ -115,6 +116,26 @@ class SQL():
 
         return result
 
+    def get_invitation_hashes(self, *courseIds):
+        """
+        Set of invitation hashes (see hash_student) for the given courses,
+        or for every course if none are given, fetched in a single query
+        """
+        q = "SELECT hash FROM oimr_invitations"
+        if courseIds:
+            q += " WHERE course_Id IN ({})".format(', '.join(['%s'] * len(courseIds)))
+
+        cur = self.cursor()
+        try:
+            cur.execute(q, courseIds)
+            result = {r[0] for r in cur.fetchall()}
+        except:
+            result = None
+        finally:
+            cur.close()
+
+        return result
+
     def add_invitation(self, registrantId, registrantEmail, courseId, invitationId=None, status='SENT'):
         q = """INSERT INTO oimr_invitations 
                   (hash, registrant_Id, registrant_email, course_Id, invitation_Id, invitation_status)
@@ -126,6 +147,35 @@ class SQL():
         cur.execute(q, val)
         self.conn.commit()
 
+    def add_invitations(self, invitations):
+        """
+        Record many invitations with one multi-row upsert in a single transaction
+        invitations is a list of (registrantId, registrantEmail, courseId, invitationId, status) tuples
+        Returns the affected row count, or None if the write failed
+        """
+        # An ERR row never overwrites an invitation that went out. Status goes first, as MySQL assigns left to right
+        q = """INSERT INTO oimr_invitations 
+                  (hash, registrant_Id, registrant_email, course_Id, invitation_Id, invitation_status)
+               VALUES (%s, %s, %s, %s, %s, %s)
+               ON DUPLICATE KEY UPDATE
+                  invitation_status = IF(invitation_Id IS NOT NULL AND LEFT(VALUES(invitation_status), 3) = 'ERR',
+                                         invitation_status, VALUES(invitation_status)),
+                  invitation_Id = IF(invitation_Id IS NOT NULL AND LEFT(VALUES(invitation_status), 3) = 'ERR',
+                                     invitation_Id, VALUES(invitation_Id))"""
+        val = [(hash_student(i[0], i[2]),) + tuple(i) for i in invitations]
+
+        cur = self.cursor()
+        try:
+            result = cur.executemany(q, val)
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            result = None
+        finally:
+            cur.close()
+
+        return result
+
 
 if __name__ == '__main__':
     pass
\ No newline at end of file
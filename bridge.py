@@ -6,61 +6,139 @@ Purpose:
     Read registration data from RegFox, determine enrollments/withdrawals, and
     execute Google API commands to make all necessary updates.
 
+Importing this module has no side effects: the DB tunnel, secrets, Slack and
+Google clients are set up by startup() or on first use, and the heavy modules
+below are only imported when something needs them.
+Run with --profile-imports to log how long each import and startup step took.
+
 """
 
 import sys
-import traceback
-import pyAnyConnect as OIMRMySQL
-import registration
-import enrollment
-import traceback
-import courses
+import time
 import logging
+import importlib
 import json
-from slack import WebClient
-from slack.errors import SlackApiError
-
-logging.basicConfig(
-    level=logging.DEBUG,
-    filename='bridge_tts.log',
-    format='%(asctime)s %(levelname)s (%(module)s:%(funcName)s:%(lineno)d) - %(msg)s'
-)
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-logging.info("########### tunnel script started ###########")
+# Seconds spent on each lazy import and startup step, for startup_report()
+TIMINGS = {}
 
-# OIMRMySQL checks for the existence tunnel_secrets.json so no need to put it here.
-# sql is the returned API not the connection or cursor so we retrieve the connection as pconn and subsequent mysqly calls will open cursors in the sql interface as well as close on completion.
-# connection and tunnel will remain open until end of the run of this file.
-with OIMRMySQL.get_pyAnywhereAPI() as sql:
-    logging.debug('Get PyAnywhere Class (tunnel)...')
-    if not sql.gPaTunnel == None:
-        # use the tunnel connection which will have the additional port
-        try:
-            pConn = sql.make_mysql_connection(True)
-        except:
-            msg = traceback.print_exception()
-            print(msg)
-        # Do tunnel things
-    else:
-        try:
-            # otherwise use a local connection up in pythonAnywhere using limited local creds
-            pConn = sql.make_mysql_connection(False)
+def timed(name, func, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        TIMINGS[name] = TIMINGS.get(name, 0) + time.perf_counter() - start
+
+class LazyModule():
+    """ Stand-in for a module that is imported (and timed) on first attribute access """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = timed('import ' + self._name, importlib.import_module, self._name)
+        return getattr(self._module, attr)
+
+OIMRMySQL = LazyModule('pyAnyConnect')
+registration = LazyModule('registration')
+enrollment = LazyModule('enrollment')
+slack = LazyModule('slack')
+slack_errors = LazyModule('slack.errors')
+
+# Local copy of RegFox registrants, so each run only fetches what changed
+# Kept outside the repo, since it's full of personal data
+REGFOX_STORE = '~/.oimr/regfox_store.json'
+
+# Columns written to oimr_registrations, and rows per upsert
+REGISTRATION_COLUMNS = ('registrant_id', 'First_Name', 'Last_Name', 'Email', 'registrant_json', 'registrant_digest')
+REGISTRATION_CHUNK = 200
+
+# Worker threads per external service in pipeline mode (see run_pipeline)
+# None for 'db' means one per pooled DB connection (pyAnyConnect.POOL_SIZE)
+# The Google client is built on httplib2, which isn't thread-safe, so it gets one worker
+PIPELINE_WORKERS = {
+    'db': None,
+    'google': 1,
+    'slack': 1
+}
+
+# Set while the pipeline runs, so Slack posts don't hold up other work
+slack_pool = None
+
+# Services, set up by startup() and the get_*() functions below
+sql = None
+sekrets = None
+slack_client = None
+google_api = None
+google_lock = threading.Lock()
+
+
+def startup():
+    """
+    Set up logging, open the tunnel and DB pool, and load secrets.
+    Call once before main(); nothing here happens at import time.
+    """
+    global sql, sekrets
 
-        except:
-            msg = sys.exc_info()[2]
-            # traceback.print_exception(sys.etype,sys.value, sys.tb)
-            print(msg)
-            # TODO: MAY WANT TO HANDLE HOW
+    logging.basicConfig(
+        level=logging.DEBUG,
+        filename='bridge_tts.log',
+        format='%(asctime)s %(levelname)s (%(module)s:%(funcName)s:%(lineno)d) - %(msg)s'
+    )
 
-sekrets = sql.get_sekrets()
+    logging.info("########### tunnel script started ###########")
 
-slack_client = WebClient(**sekrets['slack'])
+    # OIMRMySQL checks for the existence tunnel_secrets.json so no need to put it here.
+    # sql is the returned API not the connection or cursor; subsequent mysql calls will open cursors in the sql interface as well as close on completion.
+    # connection and tunnel will remain open until exit_connections() is called.
+    sql = timed('connect to DB', OIMRMySQL.get_pyAnywhereAPI)
+    logging.debug('Get PyAnywhere Class (tunnel)...')
+    # use the tunnel connection which will have the additional port,
+    # otherwise use a local connection up in pythonAnywhere using limited local creds
+    if timed('check DB pool', sql.make_mysql_connection, sql.gPaTunnel is not None) is None:
+        logging.error('Unable to connect to the DB')
+
+    sekrets = timed('load secrets', sql.get_sekrets)
+    if sekrets is None:
+        raise RuntimeError('Unable to load secrets from the DB')
+
+def get_slack_client():
+    global slack_client
+    if slack_client is None:
+        slack_client = slack.WebClient(**sekrets['slack'])
+    return slack_client
+
+def get_google_api():
+    """ The GoogleAPI client, authenticated the first time it's needed """
+    global google_api
+    with google_lock:
+        if google_api is None:
+            google_api = timed('Google auth', enrollment.GoogleAPI, sekrets['google'])
+    return google_api
+
+def startup_report():
+    """ Time spent on each import and startup step, slowest first """
+    lines = ['Startup profile:']
+    for name, seconds in sorted(TIMINGS.items(), key=lambda x: -x[1]):
+        lines.append('{:8.3f}s  {}'.format(seconds, name))
+    return '\n'.join(lines)
 
 
 def post_to_slack(message, channel='G01BV8478D7'):
     """
     Post $message to Slack in $channel (default=#enrollment-feed)
+    In pipeline mode, the post is queued and this returns straight away
     """
+    if slack_pool is not None:
+        slack_pool.submit(_post_to_slack, message, channel)
+    else:
+        _post_to_slack(message, channel)
+
+def _post_to_slack(message, channel):
     logging.debug('post_to_slack() started with arguments:\n message: {}\n channel: {}'.format(message, channel))
 
     body = {
@@ -69,33 +147,44 @@ def post_to_slack(message, channel='G01BV8478D7'):
     }
 
     try:
-        response = slack_client.chat_postMessage(**body)
-    except SlackApiError as e:
+        response = get_slack_client().chat_postMessage(**body)
+    except slack_errors.SlackApiError as e:
         logging.exception('Error sending message to Slack')
 
-def get_regfox_data(regfox_api):
+def get_regfox_data(regfox_api, incremental=True):
     """
     Fetch registrant data from RegFox, and return it as a RegistrantList object
+    If incremental, only changes since the last run are fetched and merged into REGFOX_STORE
     """
     logging.debug('get_regfox_data() started')
-    registrants = regfox_api.get_registrants()
-    registrants = registration.RegistrantList(registrants)
+    if incremental:
+        store = registration.RegistrantStore(REGFOX_STORE)
+        changes = regfox_api.sync_registrants(store)
+        logging.info('{} changed registrants fetched from RegFox (high-water mark {})'.format(len(changes), store.high_water_mark))
+        registrants = registration.RegistrantList(store.registrants, compact=True)
+    else:
+        registrants = registration.RegistrantList.from_stream(regfox_api.iter_registrants(), compact=True)
     logging.info('Registrant list fetched with {} entries.'.format(len(registrants)))
+    summary = registrants.summary()
     # Post unique reg count to Slack so we can keep an eye on it
-    post_to_slack('{} registrants fetched from RegFox'.format(registrants.registrant_count))
+    post_to_slack('{} registrants fetched from RegFox ({} duplicates)'.format(summary.unique, summary.duplicates))
     return registrants
 
-def make_commons_invite_list(registrants):
+def make_commons_invite_list(registrants, already_invited=None):
     """
     Look at registrations and identify students who do not have a commons enrollment in the db
+    $already_invited is a set of commons invitation hashes, loaded from the DB if not given
     """
     logging.debug('make_commons_invite_list() started')
 
     result = []
 
-    # already_invited = DB query to pull all students with enrollments in the commons
-    already_invited = sql.get_commons_invitations()
-    logging.debug(already_invited)
+    # already_invited = set of invitation hashes for the commons
+    if already_invited is None:
+        already_invited = sql.get_invitation_hashes('commons1')
+    if already_invited is None:
+        raise RuntimeError('Unable to load commons invitations from the DB')
+    logging.debug('{} commons invitations in DB'.format(len(already_invited)))
 
     for r in registrants:
         invHash = OIMRMySQL.hash_student(r.registrationId, 'commons1')
@@ -120,106 +209,361 @@ def invite_student(registrant, courseId, google_api):
         result = google_api.add_student(courseId=alias, studentEmail=registrant.email_addr)
         logging.debug(result)
     except enrollment.HttpError as e:
-        headers, details = e.args
+        return record_invitation(registrant, courseId, error=e)
+    except:
+        logging.exception('Encountered an unexpected error')
+    else:
+        return record_invitation(registrant, courseId, result=result)
+
+def invite_students(registrants, courseId, google_api=None):
+    """
+    Invite all $registrants to $course with batched requests
+    Returns counts of (invited, errors)
+    """
+    logging.debug('invite_students() started with params: {} registrants, course={}'.format(len(registrants), courseId))
+    google_api = google_api or get_google_api()
+
+    by_request_id = {r.registrationId: r for r in registrants}
+    status = [0, 0]
+
+    # Results are buffered and written in bulk; whatever is buffered is flushed even if a batch fails
+    with OIMRMySQL.InvitationWriter(sql) as writer:
+        def callback(request_id, response, exception):
+            registrant = by_request_id[request_id]
+            if exception is None:
+                logging.debug(response)
+                ok = record_invitation(registrant, courseId, result=response, writer=writer)
+            elif isinstance(exception, enrollment.HttpError):
+                ok = record_invitation(registrant, courseId, error=exception, writer=writer)
+            else:
+                logging.error('Encountered an unexpected error inviting {!r} - {}'.format(registrant, exception))
+                ok = False
+            status[0 if ok else 1] += 1
+
+        try:
+            google_api.add_students('d:' + courseId, ((r.registrationId, r.email_addr) for r in registrants), callback)
+        except:
+            # Students whose batch never ran are picked up again on the next run
+            logging.exception('Encountered an unexpected error')
+
+    return tuple(status)
+
+def record_invitation(registrant, courseId, result=None, error=None, writer=None):
+    """
+    Record the outcome of an invitation in the DB, and return True if it was sent
+    Pass an OIMRMySQL.InvitationWriter as $writer to buffer the DB write
+    """
+    add_invitation = writer.add if writer else sql.add_invitation
+
+    if error is not None and enrollment.is_retryable(error):
+        # Still throttled after retries - leave it out of the DB so the next run tries again
+        msg = 'Gave up inviting {!r} to course {} for now - throttled (HTTP {})'.format(registrant, courseId, error.resp.status)
+        logging.warning(msg)
+        post_to_slack(':hourglass: ' + msg)
+        return False
+
+    if error is not None:
+        headers, details = error.args
         details = json.loads(details.decode())
         msg = 'Encountered error inviting {!r} to course {} - {}'.format(registrant, courseId, details['error']['status'])
         # Silence errors on future runs by adding with null invitationId and an error code
-        sql.add_invitation(registrant.registrationId, registrant.email_addr, courseId, status='ERR:{}'.format(details['error']['status']))
-        logging.exception(msg)
+        add_invitation(registrant.registrationId, registrant.email_addr, courseId, status='ERR:{}'.format(details['error']['status']))
+        logging.error(msg)
         post_to_slack(':warning: ' + msg)
         return False
-    except:
-        logging.exception('Encountered an unexpected error')
-    else:
-        logging.info('{!r} invited to course {} with studentId {}'.format(registrant, courseId, result['id']))
-        sql.add_invitation(registrant.registrationId, registrant.email_addr, courseId, invitationId=result['id'])
-        # DB insert to add student to students table with studentId from response
-        return True
 
-def generate_change_list(registrants):
+    logging.info('{!r} invited to course {} with studentId {}'.format(registrant, courseId, result['id']))
+    add_invitation(registrant.registrationId, registrant.email_addr, courseId, invitationId=result['id'])
+    # DB insert to add student to students table with studentId from response
+    return True
+
+def generate_change_list(registrants, enrollments=None):
     """
     GENERATOR METHOD - NOT FUNCTION
     Iterate over registrants, comparing against enrollments from DB
-    When changes need to occur, yield result
+    When changes need to occur, yield (registrationId, {'add': [...], 'remove': [...]})
+    Anyone enrolled in the DB who's no longer a valid registrant (cancelled, refunded...)
+    is withdrawn from everything. Use registrants.find_registrant() to get the Registrant.
+    $enrollments is a snapshot from sql.get_enrollments(), loaded here if not given
     """
     logging.debug('change_list() started')
 
     # DB call to pull all enrollments except commons from DB
-    enrollments = []
-
+    # {registrant_Id: {course_Id: invitation_status}}, keyed like the invitations table
+    if enrollments is None:
+        enrollments = sql.get_enrollments()
+        if enrollments is None:
+            raise RuntimeError('Unable to load enrollments from the DB')
+
+    def withdrawable(enrolled, wanted=()):
+        # Courses no longer in registration, skipping invitations that never went out
+        return [
+            course for course, status in enrolled.items()
+            if course not in wanted and not (status or '').startswith('ERR')
+        ]
+
+    seen = set()
     for r in registrants:
+        seen.add(r.registrationId)
+        enrolled = enrollments.get(r.registrationId, {})
+
+        wanted = list(r.core_courses or [])
+        if r.extras:
+            wanted.append('tradhall1')
+
         # Find courses needing enrollment
-        courses_to_add = []
-        if r.core_courses:
-            for course in r.core_courses:
-                if (r.oimr_id, course) not in enrollments:
-                    courses_to_add.append(course)
-        if r.extras and (r.oimr_id, 'tradhall1') not in enrollments:
-            courses_to_add.append('tradhall1')
+        courses_to_add = [course for course in wanted if course not in enrolled]
 
         # Find courses needing withdrawal
-        courses_to_remove = []
-        # Iterate enrollments for student
-        # Append courses no longer in registration
+        courses_to_remove = withdrawable(enrolled, wanted)
 
         # Only yield result if there are changes
         if courses_to_add or courses_to_remove:
-            yield r, {'add': courses_to_add, 'remove': courses_to_remove}
+            yield r.registrationId, {'add': courses_to_add, 'remove': courses_to_remove}
+
+    # Enrolled, but not among the registrants any more
+    for registrantId, enrolled in enrollments.items():
+        if registrantId in seen:
+            continue
+        courses_to_remove = withdrawable(enrolled)
+        if courses_to_remove:
+            yield registrantId, {'add': [], 'remove': courses_to_remove}
+
 
+def registrant_digest(registrant_json):
+    """ Content hash of a registrant's JSON, stored in oimr_registrations.registrant_digest """
+    return hashlib.md5(registrant_json.encode()).hexdigest()
 
-def mysql_update_registrants(registrants):
+def mysql_update_registrants(registrants, digests=None):
     """
      Create a hash of the registrant's full name,
      date of birth, and email to serve as a unique ID  and class registration
+     If $digests ({registrant_id: registrant_digest}, as stored in the DB) is given,
+     registrants whose JSON hasn't changed are left out
      """
+    digests = digests or {}
     studentsRegistered = []
     for student in registrants:
+        # Compact registrants rehydrate _raw on every read, so only do it once
+        raw = student._raw
+        # sort_keys so the same data always gives the same digest
+        registrant_json = json.dumps(raw, sort_keys=True)
+        digest = registrant_digest(registrant_json)
+        if digests.get(raw["displayId"]) == digest:
+            continue
+
         student_Registered = {}
-        reg_date_created = student.dateCreated
-        for fd in student._raw['fieldData'] or []:
+        for fd in raw['fieldData'] or []:
             if fd.get('label') == 'First Name':
                 student_Registered['First_Name'] = fd.get('value')
             if fd.get('label') == 'Last Name':
                 student_Registered['Last_Name'] = fd.get('value')
 
-        student_Registered['registrant_id'] = student._raw["displayId"]
+        student_Registered['registrant_id'] = raw["displayId"]
         student_Registered['Email'] = student.email_addr
-        student.dateCreated = student.dateCreated.strftime('%Y-%m-%d %H:%M:%S')
-        student_Registered['registrant_json'] = json.dumps(student._raw)
+        student_Registered['registrant_json'] = registrant_json
+        student_Registered['registrant_digest'] = digest
 
         studentsRegistered.append(student_Registered)
 
     return studentsRegistered
 
-def main(regfox_api, google_api):
+def update_registrations(registrants, digests=None):
+    """
+    Upsert new or changed $registrants into oimr_registrations, REGISTRATION_CHUNK rows at a time
+    $digests is {registrant_id: registrant_digest}, fetched from the DB if not given
+    Returns the number of rows written
+    """
+    if digests is None:
+        # None if the lookup failed, in which case everyone is written
+        digests = sql.get_registrant_digests() or {}
+    regDict = mysql_update_registrants(registrants, digests)
+    logging.info('{} of {} registrants new or changed'.format(len(regDict), len(registrants)))
+    report = sql.table_insert_update('oimr_registrations', regDict, columns=REGISTRATION_COLUMNS,
+                                     max_rows=REGISTRATION_CHUNK)
+    written = sum(chunk['rows'] for chunk in report if 'error' not in chunk)
+    logging.info('{} rows written to oimr_registrations in {} chunk(s)'.format(written, len(report)))
+    return written
+
+def sync_accepted_invitations(courseIds=('commons1',), google_api=None):
+    """
+    Mark SENT invitations in $courseIds as ACCEPTED once they're no longer pending in Classroom
+    Returns the number of invitations updated, or None if the DB update failed
+    """
+    google_api = google_api or get_google_api()
+    pending = google_api.pending_invitation_ids(courseIds)
+    logging.debug('{} invitations pending in {}'.format(len(pending), ', '.join(courseIds)))
+    accepted = sql.update_course_invites(pending, courseIds)
+    logging.info('{} invitations accepted since the last run'.format(accepted))
+    return accepted
+
+def reconcile_with_classroom(courseIds, google_api=None):
+    """
+    Compare oimr_invitations against the Classroom rosters for $courseIds, taking Classroom as the truth
+    Returns {courseId: {'enrolled': [...], 'pending': [...], 'missing': [...], 'untracked': [...]}}
+      enrolled/pending/missing: registrant_Ids whose student is in the course / whose invitation
+        is still pending / who are in neither (invitation declined or deleted, or student removed)
+      untracked: emails of students in the course with no row in the DB
+    Invitations that never went out (ERR rows) are left out
+    """
+    google_api = google_api or get_google_api()
+    result = {}
+
+    for courseId in courseIds:
+        invitations = sql.get_invitations_for_course(courseId)
+        if invitations is None:
+            raise RuntimeError('Unable to load invitations for {} from the DB'.format(courseId))
+
+        alias = enrollment.course_alias(courseId)
+        students = {s['profile']['emailAddress'].lower() for s in google_api.iter_students(alias)}
+        pending = {i['id'] for i in google_api.iter_invitations(alias, fields='id')}
+
+        course = {'enrolled': [], 'pending': [], 'missing': [], 'untracked': []}
+        emails = set()
+        for row in invitations.values():
+            if (row['invitation_status'] or '').startswith('ERR'):
+                continue
+            email = (row['registrant_email'] or '').lower()
+            emails.add(email)
+            if email in students:
+                course['enrolled'].append(row['registrant_Id'])
+            elif row['invitation_Id'] in pending:
+                course['pending'].append(row['registrant_Id'])
+            else:
+                course['missing'].append(row['registrant_Id'])
+        course['untracked'] = sorted(students - emails)
+
+        logging.info('{}: {}'.format(courseId, ', '.join('{} {}'.format(len(v), k) for k, v in course.items())))
+        result[courseId] = course
+
+    return result
+
+def commons_status_line(status):
+    return '* Invited {} to commons ({} error{})'.format(status[0], status[1], 's' if any((not(status[1]), status[1] > 1)) else '')
+
+def summarize_enrollment_changes(registrants, summary, enrollments=None):
+    """
+    Make the list of tradhall/corecourse changes and add its line to $summary
+    If the enrollments can't be loaded, the invites have already gone out, so
+    the run carries on and the summary says so rather than being lost
+    """
+    try:
+        change_list = dict(generate_change_list(registrants, enrollments))
+    except RuntimeError as e:
+        logging.error(e)
+        summary.append('* Enrollment diff unavailable')
+        return None
+
+    logging.debug(change_list)
+    summary.append('* {} students with enrollment changes'.format(len(change_list)))
+    return change_list
+
+
+def run_pipeline(regfox_api, google_api=None, incremental=True):
+    """
+    Pipeline version of main(): registrants are handled page by page as they arrive
+    from RegFox, while DB upserts, Google invitations and Slack posts run on their
+    own thread pools (sized by PIPELINE_WORKERS), so the services' I/O overlaps.
+    If incremental, only changed registrants are fetched (see get_regfox_data) and
+    the stored list is swept for stragglers at the end.
+    """
+    global slack_pool
+    logging.debug('run_pipeline() started')
+    summary = ['Execution summary:\n']
+
+    db_pool = ThreadPoolExecutor(PIPELINE_WORKERS['db'] or OIMRMySQL.POOL_SIZE)
+    google_pool = ThreadPoolExecutor(PIPELINE_WORKERS['google'])
+    slack_pool = ThreadPoolExecutor(PIPELINE_WORKERS['slack'])
+
+    try:
+        already_invited = db_pool.submit(sql.get_invitation_hashes, 'commons1')
+        digests = db_pool.submit(sql.get_registrant_digests)
+        enrollments = db_pool.submit(sql.get_enrollments)
+        db_jobs = []
+        invite_jobs = []
+        to_invite = []
+        queued = set()
+
+        def queue_invites(registrants, flush=False):
+            invitees = make_commons_invite_list(registrants, already_invited.result())
+            to_invite.extend(r for r in invitees if r.registrationId not in queued)
+            queued.update(r.registrationId for r in invitees)
+            while len(to_invite) >= enrollment.BATCH_SIZE or (flush and to_invite):
+                batch = to_invite[:enrollment.BATCH_SIZE]
+                del to_invite[:enrollment.BATCH_SIZE]
+                invite_jobs.append(google_pool.submit(invite_students, batch, 'commons1', google_api))
+
+        if incremental:
+            store = registration.RegistrantStore(REGFOX_STORE)
+            pages = regfox_api.iter_sync_pages(store)
+        else:
+            store = None
+            pages = regfox_api.iter_pages()
+
+        registrants = registration.RegistrantList([], compact=True)
+        for page in pages:
+            page = registration.RegistrantList(page, compact=True)
+            registrants.extend(page)
+            db_jobs.append(db_pool.submit(lambda p: update_registrations(p, digests.result() or {}), page))
+            queue_invites(page)
+
+        if store:
+            logging.info('{} changed registrants fetched from RegFox (high-water mark {})'.format(len(registrants), store.high_water_mark))
+            # Anyone stored but never invited (e.g. a failed batch on an earlier run)
+            registrants = registration.RegistrantList(store.registrants, compact=True)
+        queue_invites(registrants, flush=True)
+
+        reg_summary = registrants.summary()
+        post_to_slack('{} registrants fetched from RegFox ({} duplicates)'.format(reg_summary.unique, reg_summary.duplicates))
+        summary.append('* {} student(s) to invite to Commons'.format(len(queued)))
+
+        for job in db_jobs:
+            job.result()
+
+        if invite_jobs:
+            status = [0, 0]
+            for job in invite_jobs:
+                invited, errors = job.result()
+                status[0] += invited
+                status[1] += errors
+            summary.append(commons_status_line(status))
+
+        summarize_enrollment_changes(registrants, summary, enrollments.result())
+
+        post_to_slack('\n'.join(summary))
+    finally:
+        db_pool.shutdown()
+        google_pool.shutdown()
+        slack_pool.shutdown()
+        slack_pool = None
+
+def main(regfox_api, google_api=None, pipeline=False):
+    """
+    Run the bridge. If $google_api isn't given, it's only created if there's
+    someone to invite.
+    """
     logging.debug('main block started')
     logging.debug(regfox_api)
     logging.debug(google_api)
+
+    if pipeline:
+        return run_pipeline(regfox_api, google_api)
+
     summary = ['Execution summary:\n']
 
     # Get registered students from RegFox
     registrants = get_regfox_data(regfox_api)
     # update registrants in Mysql Database
-    regDict = mysql_update_registrants(registrants)
-    regUpdate = sql.table_insert_update('oimr_registrations', regDict)
-    logging.info(regUpdate)
+    update_registrations(registrants)
 
     # Deal with The Commons
     enroll_in_commons = make_commons_invite_list(registrants)
     summary.append('* {} student(s) to invite to Commons'.format(len(enroll_in_commons)))
     if enroll_in_commons:
-        status = [0, 0]
-        for student in enroll_in_commons:
-            if invite_student(student, 'commons1', google_api):
-                status[0] += 1
-            else:
-                status[1] += 1
-        summary.append('* Invited {} to commons ({} error{})'.format(status[0], status[1], 's' if any((not(status[1]), status[1] > 1)) else ''))
+        status = invite_students(enroll_in_commons, 'commons1', google_api)
+        summary.append(commons_status_line(status))
 
-    # Make the list of tradhall/corecourse changes
-    #change_list = dict(generate_change_list(registrants))
-    #logging.debug(change_list)
-    #summary.append('* {} students with enrollment changes'.format(len(change_list)))
+    summarize_enrollment_changes(registrants, summary)
 
     post_to_slack('\n'.join(summary))
     return
@@ -227,8 +571,13 @@ def main(regfox_api, google_api):
 
 
 if __name__ == '__main__':
+    startup()
     post_to_slack(':sparkles: Bridge script started :sparkles:')
     regfox_api = registration.RegFoxAPI(**sekrets['regfox'])
-    google_api = enrollment.GoogleAPI(sekrets['google'])
-    main(regfox_api, google_api)
-    sql.exit_connections
+    try:
+        main(regfox_api, pipeline='--pipeline' in sys.argv)
+    finally:
+        sql.exit_connections()
+        if '--profile-imports' in sys.argv:
+            logging.info(startup_report())
+            print(startup_report())
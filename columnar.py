@@ -0,0 +1,109 @@
+"""
+Columnar (NumPy) view of a RegistrantList, for analytics over large lists
+
+Registrant data is pulled out once into arrays - totals, donations, ages,
+creation times, country codes and a registrant x course matrix - so report
+metrics are array reductions instead of Python loops over properties.
+
+NumPy is optional; it's only needed if this module is used:
+
+    columns = registrants.columns()
+    columns.core_course_count()
+"""
+
+import numpy as np
+from collections import Counter
+import courses
+import registration
+
+# Lower bound of each age range in registration.AGE_RANGES, plus 90+
+AGE_EDGES = [b for b, t in registration.AGE_RANGES] + [90]
+
+
+class RegistrantColumns():
+    def __init__(self, registrants):
+        registrants = list(registrants)
+
+        self.registration_ids = np.array([r.registrationId for r in registrants], dtype=object)
+        self.total = np.array([r.total for r in registrants], dtype=np.float64)
+        self.donation = np.array([r.donation for r in registrants], dtype=np.float64)
+        self.age = np.array([r.age for r in registrants], dtype=np.int32)
+        self.created = np.array([r.dateCreated for r in registrants], dtype='datetime64[s]')
+
+        # Categorical columns: codes index into the matching labels array
+        self.oimr_labels, self.oimr_codes = self._categorize(r.oimr_id for r in registrants)
+        self.country_labels, self.country_codes = self._categorize(
+            r.country for r in registrants)
+
+        # Registrant x course membership
+        self.course_labels = courses.list_all_courses()
+        self.courses = self._membership(registrants, self.course_labels, lambda r: r.core_courses)
+        self.qa_labels = courses.list_all_liveQA()
+        self.qa_forums = self._membership(registrants, self.qa_labels, lambda r: r.qa_forums)
+
+    @staticmethod
+    def _categorize(values):
+        values = list(values)
+        labels = list(dict.fromkeys(values))
+        lookup = {v: i for i, v in enumerate(labels)}
+        codes = np.array([lookup[v] for v in values], dtype=np.int32)
+        return labels, codes
+
+    @staticmethod
+    def _membership(registrants, labels, get_codes):
+        column = {c: i for i, c in enumerate(labels)}
+        matrix = np.zeros((len(registrants), len(labels)), dtype=bool)
+        for row, r in enumerate(registrants):
+            for code in get_codes(r) or []:
+                if code in column:
+                    matrix[row, column[code]] = True
+        return matrix
+
+    def __len__(self):
+        return len(self.total)
+
+    @property
+    def registrant_count(self):
+        """ Count unique registrants, using Registrant.oimr_id as a key """
+        return int(np.unique(self.oimr_codes).size)
+
+    def income(self):
+        total = float(self.total.sum())
+        donations = float(self.donation.sum())
+        return {
+            'registrations': total - donations,
+            'donations': donations,
+            'total': total
+        }
+
+    def age_breakdown(self):
+        """ Same result as RegistrantList.age_breakdown """
+        bins = np.bincount(np.digitize(self.age, AGE_EDGES), minlength=len(AGE_EDGES) + 1)
+        result = registration.empty_age_breakdown()
+        for (b, t), count in zip(registration.AGE_RANGES, bins[1:-1]):
+            result['{}-{}'.format(b, t)] += int(count)
+        if bins[-1]:
+            result['90+'] += int(bins[-1])
+        if bins[0]:
+            # Under 12 has no range
+            result[None] += int(bins[0])
+        return result
+
+    def country_count(self):
+        counts = np.bincount(self.country_codes, minlength=len(self.country_labels))
+        return Counter(dict(zip(self.country_labels, counts.tolist())))
+
+    def core_course_count(self):
+        return Counter(dict(zip(self.course_labels, self.courses.sum(axis=0).tolist())))
+
+    def live_qa_count(self):
+        return Counter(dict(zip(self.qa_labels, self.qa_forums.sum(axis=0).tolist())))
+
+    def hourly_buckets(self):
+        """ Counter of registrations per hour, as RegistrantList.hourly_buckets """
+        hours, counts = np.unique(self.created.astype('datetime64[h]'), return_counts=True)
+        return Counter(dict(zip(hours.astype('datetime64[s]').tolist(), counts.tolist())))
+
+    def course_roster(self, course):
+        """ Registration ids of everyone in $course """
+        return self.registration_ids[self.courses[:, self.course_labels.index(course)]].tolist()
@@ -1,13 +1,19 @@
 #!/usr/bin/python3.7
 from __future__ import print_function
 import pickle
+import hashlib
 import os.path
+import googleapiclient
 from googleapiclient.discovery import build
+from googleapiclient.discovery_cache.base import Cache
 from googleapiclient.errors import HttpError
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 import json
+import time
+import random
 import logging
+import threading
 
 logging.getLogger('googleapiclient.discovery_cache').setLevel(logging.ERROR)
 
@@ -21,14 +27,196 @@ SCOPES = [
     'https://www.googleapis.com/auth/classroom.profile.photos'
 ]
 
+# Classroom accepts at most 50 calls per batch request
+BATCH_SIZE = 50
+
+# Local copies of the API discovery documents, so each run doesn't have to fetch them
+# Bump DISCOVERY_CACHE_VERSION to throw away everything cached so far
+# google-api-python-client 2.x ships the discovery documents and build() never fetches
+# or caches them, so FileDiscoveryCache is only used on 1.x (or if one is passed in)
+STATIC_DISCOVERY = int(googleapiclient.__version__.split('.')[0]) >= 2
+DISCOVERY_CACHE_DIR = '~/.oimr/discovery_cache'
+DISCOVERY_CACHE_VERSION = 1
+DISCOVERY_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Sustained calls per second for each API method, kept under the per-user quotas
+QUOTAS = {
+    'invitations.create': 5,
+    'courses.create': 2,
+    'courses.teachers.create': 5,
+    'members.insert': 10
+}
+DEFAULT_QUOTA = 10
+
+# Items per page for list calls, so listings take as few calls as possible
+# Classroom may still return fewer; the iter_*() methods follow nextPageToken regardless
+PAGE_SIZES = {
+    'courses.list': 500,
+    'courses.students.list': 500,
+    'courses.teachers.list': 500,
+    'invitations.list': 500
+}
+
+# Default fields mask for each list call's items - just what the bridge reads
+LIST_FIELDS = {
+    'courses': 'id,name,section,courseState,alternateLink',
+    'students': 'userId,profile(emailAddress,name/fullName)',
+    'teachers': 'userId,profile(emailAddress,name/fullName)',
+    'invitations': 'id,userId,courseId,role'
+}
+
+# Errors worth retrying: throttling and transient server trouble
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_REASONS = ('RESOURCE_EXHAUSTED', 'UNAVAILABLE', 'rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+MAX_RETRIES = 5
+
 def course_alias(courseId):
     """ Take a courseId and return the domain alias. Ex: 'BZK' -> 'd:BZK' """
     return 'd:' + courseId
 
+def is_retryable(error):
+    """ True if an HttpError is throttling (429/RESOURCE_EXHAUSTED/quota) or a transient server error """
+    if not isinstance(error, HttpError):
+        return False
+    if int(error.resp.status) in RETRY_STATUSES:
+        return True
+    try:
+        details = json.loads(error.content.decode())['error']
+    except (ValueError, KeyError, AttributeError):
+        return False
+    reasons = [details.get('status')] + [e.get('reason') for e in details.get('errors', [])]
+    return any(r in RETRY_REASONS for r in reasons)
+
+def backoff_delay(attempt, base=1, cap=32):
+    """ Exponential backoff with full jitter: random wait up to base * 2**attempt seconds """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class TokenBucket():
+    """
+    Allow $rate calls per second on average, in bursts of up to $capacity.
+    acquire() blocks until the caller may go; it's safe to share between threads.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the tokens now, even if that runs the bucket into debt, and wait out the debt
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+class RateLimiter():
+    """ One TokenBucket per API method, created on first use """
+    def __init__(self, quotas=QUOTAS, default=DEFAULT_QUOTA):
+        self.quotas = quotas
+        self.default = default
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, method, tokens=1):
+        with self.lock:
+            if method not in self.buckets:
+                self.buckets[method] = TokenBucket(self.quotas.get(method, self.default))
+            bucket = self.buckets[method]
+        bucket.acquire(tokens)
+
+# Shared by every GoogleAPI instance, so separate code paths don't add up past the quota
+RATE_LIMITER = RateLimiter()
+
+class FileDiscoveryCache(Cache):
+    """
+    Discovery document cache for googleapiclient's build(), one file per URL.
+    Entries expire after $ttl seconds, and are keyed on DISCOVERY_CACHE_VERSION and
+    the googleapiclient version, so upgrading either starts from a clean cache.
+    """
+    def __init__(self, cache_dir=DISCOVERY_CACHE_DIR, ttl=DISCOVERY_CACHE_TTL):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.ttl = ttl
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path(self, url):
+        key = '{}|{}|{}'.format(DISCOVERY_CACHE_VERSION, googleapiclient.__version__, url)
+        return os.path.join(self.cache_dir, hashlib.md5(key.encode()).hexdigest() + '.json')
+
+    def get(self, url):
+        path = self.path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, 'r') as infile:
+                return infile.read()
+        except OSError:
+            return None
+
+    def set(self, url, content):
+        path = self.path(url)
+        try:
+            with open(path + '.tmp', 'w') as outfile:
+                outfile.write(content)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            logging.warning('Unable to cache discovery document for {}'.format(url))
+
 class GoogleAPI():
-    def __init__(self, client_config=None):
+    def __init__(self, client_config=None, limiter=RATE_LIMITER, max_retries=MAX_RETRIES, discovery_cache=None):
+        self.limiter = limiter
+        self.max_retries = max_retries
+        if discovery_cache is None and not STATIC_DISCOVERY:
+            discovery_cache = FileDiscoveryCache()
+        self.discovery_cache = discovery_cache
+        self._dir_svc = None
+        self._cls_svc = None
         self.auth(client_config)
 
+    @property
+    def dir_svc(self):
+        # Built on first use, so runs that only need Classroom skip the Directory API entirely
+        if self._dir_svc is None:
+            self._dir_svc = self.build('admin', 'directory_v1')
+        return self._dir_svc
+
+    @property
+    def cls_svc(self):
+        if self._cls_svc is None:
+            self._cls_svc = self.build('classroom', 'v1')
+        return self._cls_svc
+
+    def build(self, serviceName, version):
+        if self.discovery_cache is None:
+            # 2.x: use the documents bundled with the library, no fetch at all
+            return build(serviceName, version, credentials=self.creds, static_discovery=True)
+        if STATIC_DISCOVERY:
+            # 2.x with an explicit cache: fetch live documents, through the cache
+            return build(serviceName, version, credentials=self.creds, cache=self.discovery_cache,
+                         static_discovery=False)
+        return build(serviceName, version, credentials=self.creds, cache=self.discovery_cache)
+
+    def execute(self, request, method):
+        """
+        Execute $request under the rate limit for $method (e.g. 'invitations.create'),
+        retrying throttled or transient failures with jittered exponential backoff
+        """
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(method)
+            try:
+                return request.execute()
+            except HttpError as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                delay = backoff_delay(attempt)
+                logging.warning('{} throttled or failed ({}), retrying in {:.1f}s'.format(method, e.resp.status, delay))
+                time.sleep(delay)
+
     def auth(self, client_config=None, scopes=SCOPES):
         # Perform auth and return service
         
@@ -51,8 +239,10 @@ class GoogleAPI():
             with open('token.pickle', 'wb') as token:
                 pickle.dump(creds, token)
 
-        self.dir_svc = build('admin', 'directory_v1', credentials=creds)
-        self.cls_svc = build('classroom', 'v1', credentials=creds)
+        self.creds = creds
+        # Services are rebuilt with the new credentials when next used
+        self._dir_svc = None
+        self._cls_svc = None
 
     def add_group_member(self, group_id, email):
         # Add a member to a group in the domain
@@ -63,13 +253,52 @@ class GoogleAPI():
             }
         }
 
-        result = self.dir_svc.members().insert(**args)
+        result = self.execute(self.dir_svc.members().insert(**args), 'members.insert')
+        return result
+
+    def iter_pages(self, resource, method, key, fields, **kwargs):
+        """
+        GENERATOR: every item from a paged list call, e.g. resource=self.cls_svc.courses(),
+        method='courses.list', key='courses'. Pages are fetched as they're needed,
+        PAGE_SIZES[method] items at a time, with only $fields of each item.
+        """
+        request = resource.list(pageSize=PAGE_SIZES[method], fields='nextPageToken,{}({})'.format(key, fields), **kwargs)
+        while request is not None:
+            response = self.execute(request, method)
+            yield from response.get(key, [])
+            request = resource.list_next(request, response)
+
+    def iter_courses(self, fields=LIST_FIELDS['courses'], **filters):
+        """ GENERATOR: every Classroom in the domain, optionally filtered (e.g. courseStates=['ACTIVE']) """
+        return self.iter_pages(self.cls_svc.courses(), 'courses.list', 'courses', fields, **filters)
 
-    def list_courses(self):
+    def iter_students(self, courseId, fields=LIST_FIELDS['students']):
+        """ GENERATOR: every student in a Classroom. $courseId is an id or alias (see course_alias) """
+        return self.iter_pages(self.cls_svc.courses().students(), 'courses.students.list', 'students', fields,
+                               courseId=courseId)
+
+    def iter_teachers(self, courseId, fields=LIST_FIELDS['teachers']):
+        """ GENERATOR: every teacher in a Classroom. $courseId is an id or alias (see course_alias) """
+        return self.iter_pages(self.cls_svc.courses().teachers(), 'courses.teachers.list', 'teachers', fields,
+                               courseId=courseId)
+
+    def iter_invitations(self, courseId=None, userId=None, fields=LIST_FIELDS['invitations']):
+        """ GENERATOR: every pending invitation to a Classroom and/or for a user (at least one is required) """
+        filters = {k: v for k, v in (('courseId', courseId), ('userId', userId)) if v is not None}
+        return self.iter_pages(self.cls_svc.invitations(), 'invitations.list', 'invitations', fields, **filters)
+
+    def list_courses(self, fields=LIST_FIELDS['courses']):
         # List all Classrooms in the domain
+        return list(self.iter_courses(fields))
 
-        courses = self.cls_svc.courses().list().execute()
-        return courses['courses']
+    def pending_invitation_ids(self, courseIds):
+        """
+        Set of ids of the invitations still pending in $courseIds (e.g. ['commons1'])
+        """
+        result = set()
+        for courseId in courseIds:
+            result.update(i['id'] for i in self.iter_invitations(course_alias(courseId), fields='id'))
+        return result
 
     def get_user_from_id(self, u_id):
         # Fetch a user's data using their ID
@@ -81,7 +310,7 @@ class GoogleAPI():
         # API Ref: http://googleapis.github.io/google-api-python-client/docs/dyn/classroom_v1.courses.html#create
 
         try:
-            course = self.cls_svc.courses().create(body=body).execute()
+            course = self.execute(self.cls_svc.courses().create(body=body), 'courses.create')
         except HttpError as e:
             headers, details = e.args
             details = json.loads(details.decode())
@@ -103,9 +332,51 @@ class GoogleAPI():
             'userId': studentEmail,
             'role': role
         }
-        enrollment = self.cls_svc.invitations().create(body=body).execute()
+        enrollment = self.execute(self.cls_svc.invitations().create(body=body), 'invitations.create')
         return enrollment
 
+    def add_students(self, courseId, students, callback, role='STUDENT', batch_size=BATCH_SIZE):
+        """
+        Invite many students to a Classroom using batch requests.
+        students is an iterable of (request_id, email) pairs, where request_id is a
+        unique string. callback(request_id, response, exception) is called once per
+        student, with exception set (an HttpError) if that invitation failed.
+        Batches are rate limited like single calls, and throttled invitations are
+        retried in a later batch before their callback is given the error.
+        """
+        pending = list(students)
+        attempt = 0
+
+        while pending:
+            retry = []
+
+            def batch_callback(request_id, response, exception):
+                if exception is not None and is_retryable(exception) and attempt < self.max_retries:
+                    retry.append((request_id, emails[request_id]))
+                else:
+                    callback(request_id, response, exception)
+
+            for i in range(0, len(pending), batch_size):
+                chunk = pending[i:i + batch_size]
+                emails = dict(chunk)
+                batch = self.cls_svc.new_batch_http_request(callback=batch_callback)
+                for request_id, email in chunk:
+                    body = {
+                        'courseId': courseId,
+                        'userId': email,
+                        'role': role
+                    }
+                    batch.add(self.cls_svc.invitations().create(body=body), request_id=request_id)
+                self.limiter.acquire('invitations.create', len(chunk))
+                batch.execute()
+
+            if retry:
+                delay = backoff_delay(attempt)
+                logging.warning('{} invitations throttled, retrying in {:.1f}s'.format(len(retry), delay))
+                time.sleep(delay)
+            pending = retry
+            attempt += 1
+
     def add_teacher(self, courseId, teacherEmail):
         # Add a teacher
         
@@ -116,7 +387,7 @@ class GoogleAPI():
         }
 
         try:
-            result = self.cls_svc.courses().teachers().create(courseId=courseAlias, body=body).execute()
+            result = self.execute(self.cls_svc.courses().teachers().create(courseId=courseAlias, body=body), 'courses.teachers.create')
         except HttpError as e:
             headers, details = e.args
             details = json.loads(details.decode())
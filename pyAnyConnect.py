@@ -7,12 +7,35 @@ import time
 import json
 import collections
 import sys
+import atexit
 import logging
+import threading
+import contextlib
 from os import path
 
 sshtunnel.SSH_TIMEOUT = 5.0
 sshtunnel.TUNNEL_TIMEOUT = 5.0
 
+# Most connections kept open through the tunnel. They're opened as they're needed,
+# so a sequential run only ever makes one
+POOL_SIZE = 4
+# add_invitations() upsert: an ERR row (no invitation_Id) never overwrites an invitation that went out.
+# MySQL assigns left to right, so the status goes first, while invitation_Id still holds the old value
+INVITATION_KEEP = "invitation_Id IS NOT NULL AND LEFT(VALUES(invitation_status), 3) = 'ERR'"
+INVITATION_UPDATE = {
+    'invitation_status': 'IF({}, invitation_status, VALUES(invitation_status))'.format(INVITATION_KEEP),
+    'invitation_Id': 'IF({}, invitation_Id, VALUES(invitation_Id))'.format(INVITATION_KEEP),
+}
+# Connections idle longer than this are pinged (and reconnected if need be) before reuse
+IDLE_PING_SECONDS = 60
+# Seconds to wait for a free connection before giving up
+POOL_TIMEOUT = 300
+
+# Chunk limits for table_insert_update(). INSERT_CHUNK_BYTES should stay well
+# under the server's max_allowed_packet (4MB by default)
+INSERT_CHUNK_ROWS = 500
+INSERT_CHUNK_BYTES = 1024 * 1024
+
 logging.basicConfig(
     level=logging.INFO,
     filename='bridge.log',
@@ -58,11 +81,33 @@ def multi_dimensions(n, type):
         return type()
     return collections.defaultdict(lambda: multi_dimensions(n - 1, type))
 
+
+def row_size(row):
+    """ Rough size in bytes of a row of values once it's in an INSERT statement """
+    return sum(len(str(v).encode()) + 4 for v in row)
+
+
+def chunk_rows(rows, max_rows=INSERT_CHUNK_ROWS, max_bytes=INSERT_CHUNK_BYTES):
+    """
+    Split $rows into (chunk, size) pairs of at most $max_rows rows and about $max_bytes bytes
+    A single row bigger than $max_bytes gets a chunk of its own
+    """
+    chunk, size = [], 0
+    for row in rows:
+        n = row_size(row)
+        if chunk and (len(chunk) >= max_rows or size + n > max_bytes):
+            yield chunk, size
+            chunk, size = [], 0
+        chunk.append(row)
+        size += n
+    if chunk:
+        yield chunk, size
+
 collections.Counter()
 
 class PyAnywhereAPI():
 
-    def __init__(self, inputFile=None):
+    def __init__(self, inputFile=None, pool_size=POOL_SIZE):
         """ If an inputFile is passed, use that,
             otherwise, look for explicit values """
 
@@ -71,11 +116,15 @@ class PyAnywhereAPI():
         self.googDict = multi_dimensions(5, collections.Counter)
         self.mysqlDict = multi_dimensions(5, collections.Counter)
         self.gPaTunnel = None
-        self.gMysqlCur = None
-        self.gMysqlConn = None
         self.tunnel = None
         self.creds = None
         self.sshCreds = None
+        # Pooled connections through the tunnel, as (connection, last used) pairs.
+        # pool_slots makes callers wait when all pool_size connections are in use
+        self.pool = []
+        self.pool_size = pool_size
+        self.pool_lock = threading.Lock()
+        self.pool_slots = threading.BoundedSemaphore(pool_size)
         # ok lets make connection array and and use sshTunnel forwarding to grab a port for sqlAlchemy engine
 
         # Make the ssh tunnel into pythonAnywhere remote and bypass tunnel  running in PythonAnywhere
@@ -127,101 +176,178 @@ class PyAnywhereAPI():
         TODO: "MAKE A START/STOP TUNNEL INTERFACE TO CLEAN THINGS UP"
 
     def make_mysql_connection(self, tunnel=False):
-        # call make oimr$OIMR database connection string to correctly populate value of self.arrConn['pa']['OIMR']['connection']
-        # self.make_pyanywhere_msyql_engine_string()
-        if self.gMysqlConn is not None:
-            self.gMysqlConn.close()
-            self.gMysqlConn = None
+        # Open the first connection (through the tunnel, if there is one) and check that it works
+        # Returns True, or None if no connection could be made
         try:
-            self.gMysqlConn = mysql.connector.connect(**self.creds)
-
-            return self.gMysqlConn
+            with self.cursor(False) as cur:
+                cur.execute('SELECT 1')
+                cur.fetchall()
+            return True
         except mysqlConnErr as e:
             print(e)
+
+    def connect(self):
+        conn = mysql.connector.connect(**self.creds)
+        logging.debug("########### mysql connection opened ###########")
+        return conn
+
+    def close_pool(self):
+        with self.pool_lock:
+            idle, self.pool = self.pool, []
+        for conn, last_used in idle:
+            self.close_connection(conn)
+
+    @staticmethod
+    def close_connection(conn):
+        try:
+            conn.close()
+        except mysqlConnErr:
+            pass
+
+    def check_tunnel(self):
+        # Restart the tunnel if it has dropped; the local port may change, so idle connections are dropped
+        if self.tunnel and self.gPaTunnel is not None and not self.gPaTunnel.is_active:
+            logging.info("########### tunnel down, restarting ###########")
+            self.gPaTunnel.restart()
+            self.update_creds(self.tunnel)
+            for conn, last_used in self.pool:
+                self.close_connection(conn)
+            self.pool = []
+
+    def get_connection(self):
         """
-        if self.gMysqlConn.is_connected():
-            self.gMysqlCur = self.gMysqlConn.cursor()
-            return self.gMysqlCur
-        else:
-            if self.gMysqlConn is not None and self.gMysqlConn.is_connected():
-                self.gMysqlConn.close() """
+        Take a connection from the pool, opening one if none are idle, and waiting
+        (up to POOL_TIMEOUT seconds) if all pool_size are in use. Connections idle
+        for over IDLE_PING_SECONDS are pinged first, and reconnected if they dropped.
+        Hand it back with release_connection().
+        """
+        if not self.pool_slots.acquire(timeout=POOL_TIMEOUT):
+            raise mysqlConnErr(msg='Timed out waiting for a DB connection')
+
+        conn = None
+        try:
+            with self.pool_lock:
+                self.check_tunnel()
+                if self.pool:
+                    conn, last_used = self.pool.pop()
+            if conn is None:
+                conn = self.connect()
+            elif time.time() - last_used > IDLE_PING_SECONDS:
+                conn.ping(reconnect=True, attempts=3, delay=1)
+        except:
+            if conn is not None:
+                self.close_connection(conn)
+            self.pool_slots.release()
+            raise
 
-    def get_mysql_cursor(self, getDict=True, buffered=True):
-        # call make oimr$OIMR database connection string to correctly populate value of self.arrConn['pa']['OIMR']['connection']
-        # self.make_pyanywhere_msyql_engine_string()
+        return conn
 
+    def release_connection(self, conn, reuse=True):
+        """
+        Return $conn to the pool, or close it if it shouldn't be reused
+        (after an error, so a broken connection or half-done session isn't handed out again)
+        """
         try:
-            if self.gMysqlConn is not None:
-                self.gMysqlCur = self.gMysqlConn.cursor(buffered=buffered, dictionary=bool(getDict))
-                # if getDict:
-                #     self.gMysqlCur = self.gMysqlConn.cursor(buffered=True , dictionary=True)
-                # else:
-                #     self.gMysqlCur = self.gMysqlConn.cursor()
-
-                return self.gMysqlCur
-        except mysqlConnErr as e:
-            print(e)
-        return self.gMysqlCur
+            if reuse:
+                with self.pool_lock:
+                    self.pool.append((conn, time.time()))
+            else:
+                self.close_connection(conn)
+        finally:
+            self.pool_slots.release()
+
+    @contextlib.contextmanager
+    def cursor(self, getDict=True, buffered=True):
+        """
+        Cursor on its own pooled connection, for use in a with block.
+        Commits if the block succeeds and rolls back if it raises.
+        """
+        conn = self.get_connection()
+        try:
+            cur = conn.cursor(buffered=buffered, dictionary=bool(getDict))
+        except:
+            self.release_connection(conn, reuse=False)
+            raise
+
+        ok = False
+        try:
+            yield cur
+            conn.commit()
+            ok = True
+        except:
+            try:
+                conn.rollback()
+            except mysqlConnErr:
+                pass
+            raise
+        finally:
+            try:
+                cur.close()
+            except mysqlConnErr:
+                ok = False
+            self.release_connection(conn, reuse=ok)
 
     def get_sekrets(self):
-        self.gMysqlCur = self.get_mysql_cursor(False)
         q = 'SELECT * FROM sekrets'
         try:
-            self.gMysqlCur.execute(q)
-            result = self.gMysqlCur.fetchall()
+            with self.cursor(False) as cur:
+                cur.execute(q)
+                result = cur.fetchall()
             result = {x: json.loads(y) for x, y in result}
         except mysqlConnErr as e:
             result = None
             print(e)
-        finally:
-            if not self.gMysqlCur == None:
-                self.gMysqlCur.close()
-                self.gMysqlCur = None
 
         return result
 
-    def update_course_invites(self, pending_invites):
-        self.gMysqlCur = self.get_mysql_cursor(True)
-        q1 = """SELECT invitation_Id FROM oimr_invitations WHERE invitation_Status = 'SENT'"""
-        q2 = """UPDATE oimr_invitations SET invitatation_status = 'ACCEPTED' WHERE invitation_Id = %s"""
+    def update_course_invites(self, pending_invites, courseIds=None):
+        """
+        Mark SENT invitations ACCEPTED unless their invitation_Id is in $pending_invites,
+        the ids still pending in Classroom (see GoogleAPI.pending_invitation_ids)
+        If the pending ids only cover some courses, pass those as $courseIds
+        The ids are loaded into a temporary table and applied with a single UPDATE ... JOIN
+        Returns the number of invitations marked ACCEPTED, or None on error
+        """
+        q1 = """CREATE TEMPORARY TABLE tmp_pending_invites
+                  (invitation_Id varchar(64) NOT NULL PRIMARY KEY) ENGINE=MEMORY"""
+        q2 = "INSERT INTO tmp_pending_invites (invitation_Id) VALUES {}"
+        q3 = """UPDATE oimr_invitations i
+                  LEFT JOIN tmp_pending_invites p ON p.invitation_Id = i.invitation_Id
+                  SET i.invitation_status = 'ACCEPTED'
+                  WHERE i.invitation_status = 'SENT' AND i.invitation_Id IS NOT NULL AND p.invitation_Id IS NULL"""
+        val = ()
+        if courseIds:
+            q3 += " AND i.course_Id IN ({})".format(', '.join(['%s'] * len(courseIds)))
+            val = tuple(courseIds)
 
         try:
-            self.gMysqlCur.execute(q1)
-            result = [r[0] for r in self.gMysqlCur.fetchall()]
+            # Temporary tables belong to a connection, so it all happens on one cursor.
+            # The table is dropped at the end, and a connection that hits an error isn't reused,
+            # so it never already exists; IF EXISTS/IGNORE would only add notes, which
+            # raise_on_warnings turns into errors.
+            with self.cursor(False) as cur:
+                cur.execute(q1)
+                for chunk, size in chunk_rows([(i,) for i in set(pending_invites)]):
+                    cur.execute(q2.format(', '.join(['(%s)'] * len(chunk))), [row[0] for row in chunk])
+                cur.execute(q3, val)
+                result = cur.rowcount
+                cur.execute("DROP TEMPORARY TABLE tmp_pending_invites")
         except mysqlConnErr as e:
             result = None
             print(e)
-        finally:
-            if not self.gMysqlCur == None:
-                self.gMysqlCur.close()
-                self.gMysqlCur = None
 
-        if result:
-            try:
-                accepted = [(i,) for i in result if i not in pending_invites]
-                self.gMysqlCur.executemany(q2, accepted)
-                self.gMysqlConn.commit()
-            except mysqlConnErr as e:
-                print(e)
-            finally:
-                if not self.gMysqlCur == None:
-                    self.gMysqlCur.close()
-                    self.gMysqlCur = None
+        return result
 
     def get_student_in_course(self, studentId, courseId):
-        self.gMysqlCur = self.get_mysql_cursor(True)
         q = "SELECT * FROM oimr_invitations WHERE registrant_Id = %s AND course_Id = %s"
         val = (studentId, courseId)
 
         try:
-            self.gMysqlCur.execute(q, val)
-            result = self.gMysqlCur.fetchall()
+            with self.cursor(True) as cur:
+                cur.execute(q, val)
+                result = cur.fetchall()
         except:
             result = None
-        finally:
-            if not self.gMysqlCur == None:
-                self.gMysqlCur.close()
-                self.gMysqlCur = None
 
         return result
 
@@ -229,62 +355,169 @@ class PyAnywhereAPI():
         return self.get_invitations_for_course('commons1')
 
     def get_invitations_for_course(self, courseId):
-        self.gMysqlCur = self.get_mysql_cursor(True)
         q = "SELECT * FROM oimr_invitations WHERE course_Id = %s"
         val = (courseId,)
 
         try:
-            self.gMysqlCur.execute(q, val)
-            result = self.gMysqlCur.fetchall()
+            with self.cursor(True) as cur:
+                cur.execute(q, val)
+                result = cur.fetchall()
             result = {r['hash']: r for r in result}
         except mysqlConnErr as e:
+            result = None
             print(e)
-        finally:
-            if not self.gMysqlCur == None:
-                self.gMysqlCur.close()
 
         return result
 
-    def table_insert_update(self, tableName, dataDict):
-
-        data_tupled = []
-        for x in dataDict:
-            data_tupled.append(tuple(x.values()))
-        colUpdateStr = ', '.join(['{} = Values({})'.format(col, col) for col in dataDict[0].keys()])
-        colList = tuple(['{}'.format(key) for key in dataDict[0].keys()])
-        query = "INSERT INTO {} ({}) VALUES ({}) ON DUPLICATE KEY UPDATE {}".format(tableName, ', '.join(colList),
-                                                                                    ','.join(['%s'.format(colname) for
-                                                                                              colname in colList]),
-                                                                                    colUpdateStr)
+    def get_enrollments(self, exclude=('commons1',)):
+        """
+        Snapshot of every invitation outside the $exclude courses, loaded in one query,
+        as {registrant_Id: {course_Id: invitation_status}}
+        """
+        q = "SELECT registrant_Id, course_Id, invitation_status FROM oimr_invitations"
+        if exclude:
+            q += " WHERE course_Id NOT IN ({})".format(', '.join(['%s'] * len(exclude)))
+
+        try:
+            with self.cursor(False) as cur:
+                cur.execute(q, tuple(exclude))
+                rows = cur.fetchall()
+            result = collections.defaultdict(dict)
+            for registrantId, courseId, status in rows:
+                result[registrantId][courseId] = status
+            result = dict(result)
+        except mysqlConnErr as e:
+            print(e)
+            result = None
+
+        return result
+
+    def get_invitation_hashes(self, *courseIds):
+        """
+        Set of invitation hashes (see hash_student) for the given courses,
+        or for every course if none are given, fetched in a single query
+        """
+        q = "SELECT hash FROM oimr_invitations"
+        if courseIds:
+            q += " WHERE course_Id IN ({})".format(', '.join(['%s'] * len(courseIds)))
+
         try:
+            with self.cursor(False) as cur:
+                cur.execute(q, courseIds)
+                result = {r[0] for r in cur.fetchall()}
+        except mysqlConnErr as e:
+            print(e)
+            result = None
+
+        return result
 
-            self.gMysqlCur = self.get_mysql_cursor(True)
-            self.gMysqlCur.executemany(query, data_tupled)
-            rows = "{} affected rows in {}".format(self.gMysqlCur.rowcount, tableName)
-            self.gMysqlConn.commit()
-            return rows
+    def get_registrant_digests(self):
+        """
+        {registrant_id: registrant_digest} for every row in oimr_registrations,
+        so unchanged registrants can be skipped on upsert
+        """
+        q = "SELECT registrant_id, registrant_digest FROM oimr_registrations"
 
+        try:
+            with self.cursor(False) as cur:
+                cur.execute(q)
+                result = dict(cur.fetchall())
         except mysqlConnErr as e:
             print(e)
-        finally:
-            if not self.gMysqlCur == None:
-                self.gMysqlCur.close()
+            result = None
 
-    def add_invitation(self, registrantId, registrantEmail, courseId, invitationId=None, status='SENT'):
-        q = """INSERT INTO oimr_invitations
-                  (hash, registrant_Id, registrant_email, course_Id, invitation_Id, invitation_status)
-               VALUES (%s, %s, %s, %s, %s, %s)"""
-        val = (hash_student(registrantId, courseId), registrantId, registrantEmail, courseId, invitationId, status)
+        return result
+
+    def table_insert_update(self, tableName, dataDict, columns=None, update=None,
+                            max_rows=INSERT_CHUNK_ROWS, max_bytes=INSERT_CHUNK_BYTES, commit_each=True):
+        """
+        Bulk upsert $dataDict (a list of dicts) into $tableName with multi-row
+        INSERT ... VALUES (...), (...) ON DUPLICATE KEY UPDATE statements
+
+        columns: columns to write, in order. Defaults to every key in dataDict in
+            the order first seen; a row without one of the keys gets NULL
+        update: columns to overwrite if the row already exists (default: columns),
+            or an empty list for a plain INSERT. A dict of {column: SQL expression}
+            sets each column to its expression instead, in order
+        Rows go in chunks of at most max_rows rows and about max_bytes bytes. With
+        commit_each, each chunk is committed on its own; otherwise the whole load
+        is one transaction, and an error means nothing was written.
+
+        Returns a list with {'rows', 'bytes', 'affected', 'seconds'} for each chunk.
+        If a chunk fails, its entry has an 'error' instead, and it's the last one.
+        """
+        if not dataDict:
+            return []
+        if columns is None:
+            columns = list(dict.fromkeys(key for row in dataDict for key in row))
+        if update is None:
+            update = columns
+
+        row_values = '({})'.format(', '.join(['%s'] * len(columns)))
+        on_duplicate = ''
+        if isinstance(update, dict):
+            on_duplicate = ' ON DUPLICATE KEY UPDATE ' + ', '.join(['{} = {}'.format(*u) for u in update.items()])
+        elif update:
+            on_duplicate = ' ON DUPLICATE KEY UPDATE ' + ', '.join(['{0} = VALUES({0})'.format(col) for col in update])
+
+        rows = [tuple(row.get(col) for col in columns) for row in dataDict]
+        report = []
+
+        def write(cur, chunk, stats):
+            start = time.perf_counter()
+            query = "INSERT INTO {} ({}) VALUES {}{}".format(
+                tableName, ', '.join(columns), ', '.join([row_values] * len(chunk)), on_duplicate)
+            cur.execute(query, [v for row in chunk for v in row])
+            stats.update(affected=cur.rowcount, seconds=time.perf_counter() - start)
+            logging.info('{}: {rows} rows ({bytes} bytes), {affected} affected in {seconds:.3f}s'.format(tableName, **stats))
 
-        self.gMysqlCur = self.get_mysql_cursor(True)
         try:
-            self.gMysqlCur.execute(q, val)
-            self.gMysqlConn.commit()
+            if commit_each:
+                for chunk, size in chunk_rows(rows, max_rows, max_bytes):
+                    report.append({'rows': len(chunk), 'bytes': size})
+                    with self.cursor(False) as cur:
+                        write(cur, chunk, report[-1])
+            else:
+                with self.cursor(False) as cur:
+                    for chunk, size in chunk_rows(rows, max_rows, max_bytes):
+                        report.append({'rows': len(chunk), 'bytes': size})
+                        write(cur, chunk, report[-1])
         except mysqlConnErr as e:
             print(e)
-        finally:
-            if not self.gMysqlCur == None:
-                self.gMysqlCur.close()
+            if not commit_each or not report:
+                # Rolled back (or never started), so none of it was written
+                report = [{'rows': len(rows), 'bytes': sum(map(row_size, rows))}]
+            report[-1]['error'] = str(e)
+            logging.error('{}: {rows} rows not written: {error}'.format(tableName, **report[-1]))
+
+        return report
+
+    def add_invitation(self, registrantId, registrantEmail, courseId, invitationId=None, status='SENT'):
+        return self.add_invitations([(registrantId, registrantEmail, courseId, invitationId, status)])
+
+    def add_invitations(self, invitations):
+        """
+        Record many invitations with one multi-row upsert in a single transaction
+        invitations is a list of (registrantId, registrantEmail, courseId, invitationId, status) tuples
+        Returns the affected row count, or None if the write failed
+        """
+        columns = ('hash', 'registrant_Id', 'registrant_email', 'course_Id', 'invitation_Id', 'invitation_status')
+        val = [dict(zip(columns, (hash_student(i[0], i[2]),) + tuple(i))) for i in invitations]
+
+        report = self.table_insert_update('oimr_invitations', val, columns=columns,
+                                          update=INVITATION_UPDATE, commit_each=False)
+        if any('error' in chunk for chunk in report):
+            return None
+        return sum(chunk['affected'] for chunk in report)
+
+    def add_log_entries(self, entries):
+        """
+        Bulk load rows into oimr_logging
+        entries is a list of (log_level, module, method, line_num, mess_date, message) tuples
+        """
+        columns = ('log_level', 'module', 'method', 'line_num', 'mess_date', 'message')
+        return self.table_insert_update('oimr_logging', [dict(zip(columns, e)) for e in entries],
+                                        columns=columns, update=[])
 
     def make_log_info_entry(self, log_level, module, method, message, err_line=0):
         timeStampNow = (time.strftime("%Y-%m-%d %I:%M:%S"))
@@ -300,16 +533,61 @@ class PyAnywhereAPI():
         pass
 
     def exit_connections(self):
-        if self.gMysqlConn is not None:
-            self.gMysqlConn = None
+        if self.pool:
+            self.close_pool()
             logging.debug("########### mysql connection is no more ###########")
 
         if self.gPaTunnel is not None:
-            self.gPaTunnel.Stop
+            self.gPaTunnel.stop()
             self.gPaTunnel = None
             logging.debug("########### Tunnel Collapsed ###########")
         print("tunnel of love closed")
 
+class InvitationWriter():
+    """
+    Buffer invitation rows and write them $batch_size at a time with
+    PyAnywhereAPI.add_invitations(), instead of one round trip per row.
+    Use it as a context manager: the buffer is flushed on the way out, even
+    after an error, and again at interpreter exit as a last resort.
+    """
+    def __init__(self, api, batch_size=100):
+        self.api = api
+        self.batch_size = batch_size
+        self.rows = []
+        atexit.register(self.flush)
+
+    def add(self, registrantId, registrantEmail, courseId, invitationId=None, status='SENT'):
+        self.rows.append((registrantId, registrantEmail, courseId, invitationId, status))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return True
+
+        rows, self.rows = self.rows, []
+        if self.api.add_invitations(rows) is None:
+            # Keep the rows for the next flush
+            self.rows = rows + self.rows
+            logging.error('Unable to write {} invitations, will retry'.format(len(rows)))
+            return False
+
+        logging.debug('{} invitations written'.format(len(rows)))
+        return True
+
+    def close(self):
+        atexit.unregister(self.flush)
+        if not self.flush():
+            # Last chance - put the rows in the log so they can be replayed by hand
+            logging.error('Invitations not written to DB: {}'.format(json.dumps(self.rows)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
 def get_pyAnywhereAPI():
     paMysqlDb = PyAnywhereAPI()
 
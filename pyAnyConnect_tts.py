@@ -138,7 +138,7 @@ class PyAnywhereAPI():
     def update_course_invites(self, pending_invites):
         self.gMysqlCur = self.get_mysql_cursor()
         q1 = """SELECT invitation_Id FROM oimr_invitations WHERE invitation_Status = 'SENT'"""
-        q2 = """UPDATE oimr_invitations SET invitatation_status = 'ACCEPTED' WHERE invitation_Id = %s"""
+        q2 = """UPDATE oimr_invitations SET invitation_status = 'ACCEPTED' WHERE invitation_Id = %s"""
 
         try:
             self.gMysqlCur.execute(q1)
@@ -152,7 +152,9 @@ class PyAnywhereAPI():
                 self.gMysqlCur = None
 
         if result:
+            self.gMysqlCur = self.get_mysql_cursor()
             try:
+                pending_invites = set(pending_invites)
                 accepted = [(i,) for i in result if i not in pending_invites]
                 self.gMysqlCur.executemany(q2, accepted)
                 self.gMysqlConn.commit()
@@ -202,6 +204,50 @@ class PyAnywhereAPI():
 
         return result
 
+    def get_invitation_hashes(self, *courseIds):
+        """
+        Set of invitation hashes (see hash_student) for the given courses,
+        or for every course if none are given, fetched in a single query
+        """
+        q = "SELECT hash FROM oimr_invitations"
+        if courseIds:
+            q += " WHERE course_Id IN ({})".format(', '.join(['%s'] * len(courseIds)))
+
+        self.gMysqlCur = self.get_mysql_cursor()
+        try:
+            self.gMysqlCur.execute(q, courseIds)
+            result = {r[0] for r in self.gMysqlCur.fetchall()}
+        except mysqlConnErr as e:
+            print(e)
+            result = None
+        finally:
+            if not self.gMysqlCur == None:
+                self.gMysqlCur.close()
+                self.gMysqlCur = None
+
+        return result
+
+    def get_registrant_digests(self):
+        """
+        {registrant_id: registrant_digest} for every row in oimr_registrations,
+        so unchanged registrants can be skipped on upsert
+        """
+        q = "SELECT registrant_id, registrant_digest FROM oimr_registrations"
+
+        self.gMysqlCur = self.get_mysql_cursor()
+        try:
+            self.gMysqlCur.execute(q)
+            result = dict(self.gMysqlCur.fetchall())
+        except mysqlConnErr as e:
+            print(e)
+            result = None
+        finally:
+            if not self.gMysqlCur == None:
+                self.gMysqlCur.close()
+                self.gMysqlCur = None
+
+        return result
+
     def table_insert_update(self, tableName, dataDict):
 
         data_tupled = []
@@ -237,6 +283,39 @@ class PyAnywhereAPI():
         self.gMysqlConn.commit()
         self.gMysqlConn.close()
 
+    def add_invitations(self, invitations):
+        """
+        Record many invitations with one multi-row upsert in a single transaction
+        invitations is a list of (registrantId, registrantEmail, courseId, invitationId, status) tuples
+        Returns the affected row count, or None if the write failed
+        """
+        # An ERR row never overwrites an invitation that went out. Status goes first, as MySQL assigns left to right
+        q = """INSERT INTO oimr_invitations
+                  (hash, registrant_Id, registrant_email, course_Id, invitation_Id, invitation_status)
+               VALUES (%s, %s, %s, %s, %s, %s)
+               ON DUPLICATE KEY UPDATE
+                  invitation_status = IF(invitation_Id IS NOT NULL AND LEFT(VALUES(invitation_status), 3) = 'ERR',
+                                         invitation_status, VALUES(invitation_status)),
+                  invitation_Id = IF(invitation_Id IS NOT NULL AND LEFT(VALUES(invitation_status), 3) = 'ERR',
+                                     invitation_Id, VALUES(invitation_Id))"""
+        val = [(hash_student(i[0], i[2]),) + tuple(i) for i in invitations]
+
+        result = None
+        self.gMysqlCur = self.get_mysql_cursor()
+        try:
+            self.gMysqlCur.executemany(q, val)
+            result = self.gMysqlCur.rowcount
+            self.gMysqlConn.commit()
+        except mysqlConnErr as e:
+            self.gMysqlConn.rollback()
+            print(e)
+        finally:
+            if not self.gMysqlCur == None:
+                self.gMysqlCur.close()
+                self.gMysqlCur = None
+
+        return result
+
     def make_log_info_entry(self, log_level, module, method, message, err_line=0):
         timeStampNow = (time.strftime("%Y-%m-%d %I:%M:%S"))
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -1,42 +1,299 @@
 import courses
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
+import os
+import gzip
+import time
 import json
 import datetime
 from collections import UserList, Counter
+import functools
 import hashlib
+import zlib
 
 DATE_FMT = "%Y-%m-%dT%H:%M:%SZ"
 
+AGE_RANGES = (
+    (12, 17),
+    (18, 29),
+    (30, 39),
+    (40, 49),
+    (50, 59),
+    (60, 69),
+    (70, 79),
+    (80, 89)
+)
+
+
+def age_to_range(age):
+    if age > 89:
+        return '90+'
+
+    for b, t in AGE_RANGES:
+        if b <= age <= t:
+            return '{}-{}'.format(b, t)
+
+
+def empty_age_breakdown():
+    result = Counter({'{}-{}'.format(*x): 0 for x in AGE_RANGES})
+    result.update({'80+': 0})
+    return result
+
+
+BUCKET_WIDTHS = {
+    'hour': datetime.timedelta(hours=1),
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(weeks=1)
+}
+
+
+def bucket_start(timestamp, bucket='hour'):
+    """ Round timestamp down to the start of its hour, day or week (weeks start Monday) """
+    if bucket not in BUCKET_WIDTHS:
+        raise ValueError('Unknown bucket {!r}, expected one of {}'.format(bucket, ', '.join(BUCKET_WIDTHS)))
+
+    timestamp = timestamp.replace(minute=0, second=0, microsecond=0)
+    if bucket in ('day', 'week'):
+        timestamp = timestamp.replace(hour=0)
+    if bucket == 'week':
+        timestamp -= datetime.timedelta(days=timestamp.weekday())
+    return timestamp
+
+
+def rebucket(counts, bucket):
+    """ Merge a Counter of {bucket start: count} into wider buckets """
+    result = Counter()
+    for timestamp, count in counts.items():
+        result[bucket_start(timestamp, bucket)] += count
+    return result
+
+
+def memoized(func):
+    """ Read-only property computed once per Registrant, until its _raw changes """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self):
+        try:
+            return self._cache[name]
+        except KeyError:
+            value = self._cache[name] = func(self)
+            return value
+
+    return property(wrapper)
+
+
+def compress_raw(raw_data):
+    """ zlib-compress a list of JSON-able items (raw registrants, etc.) as JSON lines """
+    compressor = zlib.compressobj()
+    chunks = [compressor.compress((json.dumps(d) + '\n').encode()) for d in raw_data]
+    chunks.append(compressor.flush())
+    return b''.join(chunks)
+
+
+def decompress_raw(blob):
+    return [json.loads(line) for line in zlib.decompress(blob).splitlines()]
+
+
 class RegistrantList(UserList):
-    def __init__(self, data=[]):
+    # Registrant attributes find_registrant() can look up without a scan
+    INDEX_FIELDS = ('registrationId', 'email_addr', 'oimr_id', 'orderNumber', 'customer_id')
+
+    def __init__(self, data=[], compact=False):
+        # Lookup indexes, built on first use
+        self._indexes = None
         # Store as raw input
         self._data = data
         # Remove invalid entries
         self.data = [Registrant(d) for d in self.validate(data)]
+        if compact:
+            self.compact()
+
+    @classmethod
+    def from_stream(cls, raw_data, callback=None, compact=False):
+        """
+        Build a RegistrantList from an iterable of raw registrants, such as
+        RegFoxAPI.iter_registrants(), validating each one as it arrives.
+        If given, callback(registrant) is called for each valid registrant as
+        soon as it's built, so downstream work can start before the last page
+        has been fetched.
+        With compact=True, CompactRegistrants are built as the data streams in
+        (see compact()), so the full raw list is never held.
+        """
+        result = cls([])
+        invalid = []
+
+        for i, d in enumerate(raw_data):
+            if not compact:
+                result._data.append(d)
+            if result.is_valid(d):
+                r = Registrant(d)
+                if compact:
+                    r = CompactRegistrant(r)
+                result.data.append(r)
+                if callback:
+                    callback(r)
+            elif compact:
+                invalid.append((i, d))
+
+        if compact:
+            result._data = compress_raw(invalid)
+
+        return result
+
+    def compact(self):
+        """
+        Cut memory use: swap each Registrant for a CompactRegistrant, which keeps
+        its own raw JSON compressed. Only the invalid raw entries are kept at list
+        level (compressed, with their positions), so nothing is stored twice.
+        Raw data is still available, just slower.
+        """
+        self.data = [r if isinstance(r, CompactRegistrant) else CompactRegistrant(r) for r in self.data]
+        self.reset_indexes()
+        if not isinstance(self._data, bytes):
+            self._data = compress_raw([(i, d) for i, d in enumerate(self._data) if not self.is_valid(d)])
+        return self
+
+    @property
+    def raw_data(self):
+        """ The raw input list, including invalid entries """
+        if isinstance(self._data, bytes):
+            # Rebuilt from the registrants, with the invalid entries put back where they were
+            result = [r._raw for r in self.data]
+            for i, d in decompress_raw(self._data):
+                result.insert(i, d)
+            return result
+        return self._data
 
     @property
     def _raw(self):
-        return [Registrant(d) for d in self._data]
+        return [Registrant(d) for d in self.raw_data]
+
+    @property
+    def indexes(self):
+        """
+        {field: {value: [registrants]}} for each of INDEX_FIELDS, plus a
+        'course' index of core course -> registrants
+        """
+        if self._indexes is None:
+            self._indexes = {field: {} for field in self.INDEX_FIELDS + ('course',)}
+            self._index_add(self.data)
+        return self._indexes
+
+    def reset_indexes(self):
+        """ Drop the indexes, to be rebuilt on next use (e.g. after editing a registrant in place) """
+        self._indexes = None
+
+    @staticmethod
+    def _index_keys(r):
+        for field in RegistrantList.INDEX_FIELDS:
+            yield field, getattr(r, field)
+        for course in r.core_courses or []:
+            yield 'course', course
+
+    def _index_add(self, registrants):
+        if self._indexes is None:
+            return
+        for r in registrants:
+            for field, value in self._index_keys(r):
+                self._indexes[field].setdefault(value, []).append(r)
+
+    def _index_remove(self, r):
+        if self._indexes is None:
+            return
+        for field, value in self._index_keys(r):
+            bucket = self._indexes[field].get(value, [])
+            # Match on identity, so an equal duplicate isn't dropped instead
+            for i, item in enumerate(bucket):
+                if item is r:
+                    del bucket[i]
+                    break
+            if not bucket:
+                self._indexes[field].pop(value, None)
+
+    # Keep the indexes current as the list changes. Cheap incremental
+    # updates for the common cases, anything else just drops them.
+    # Editing a registrant in place (reassigning its _raw, or invalidate())
+    # isn't seen here, so call reset_indexes() after doing that.
+    def append(self, item):
+        super().append(item)
+        self._index_add([item])
+
+    def extend(self, other):
+        start = len(self.data)
+        super().extend(other)
+        self._index_add(self.data[start:])
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def remove(self, item):
+        super().remove(item)
+        self._index_remove(item)
+
+    def pop(self, i=-1):
+        item = super().pop(i)
+        self._index_remove(item)
+        return item
+
+    def insert(self, i, item):
+        super().insert(i, item)
+        self._index_add([item])
+
+    def clear(self):
+        super().clear()
+        self.reset_indexes()
+
+    def __setitem__(self, i, item):
+        super().__setitem__(i, item)
+        self.reset_indexes()
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self.reset_indexes()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.reset_indexes()
+
+    def reverse(self):
+        super().reverse()
+        self.reset_indexes()
 
     def find_registrant(self, value, field='registrationId'):
-        try:
-            result = [r for r in self.data if getattr(r, field) == value]
-        except:
-            result = []
-            
+        if field in self.INDEX_FIELDS:
+            result = self.indexes[field].get(value)
+        else:
+            try:
+                result = [r for r in self.data if getattr(r, field) == value]
+            except AttributeError:
+                result = []
+
         if result:
             return result[0]
         else:
             return False
 
+    def find_registrants(self, value, field='registrationId'):
+        """ Every registrant whose $field is $value (e.g. all registrations for an oimr_id) """
+        if field in self.INDEX_FIELDS:
+            return list(self.indexes[field].get(value, []))
+        return [r for r in self.data if getattr(r, field, None) == value]
+
     @property
     def registrant_count(self):
         """ Count unique registrants, using Registrant.oimr_id as a key """
         return len(set(r.oimr_id for r in self.data))
 
     def validate(self, data):
-        return [d for d in data if d.get('status')=='completed']
+        return [d for d in data if self.is_valid(d)]
+
+    @staticmethod
+    def is_valid(d):
+        return d.get('status') == 'completed'
 
     def core_course_count(self):
         course_count = Counter({c: 0 for c in courses.COURSES})
@@ -53,23 +310,55 @@ class RegistrantList(UserList):
 
         return qa_count
 
+    def registrants_in_course(self, course):
+        return list(self.indexes['course'].get(course, []))
+
     def regs_by_course(self, course):
-        return [r.emailAddr for r in self.data if course in r.core_courses]
+        return [r.email_addr for r in self.registrants_in_course(course)]
 
     def date_list(self):
-        result = [r.dateCreated.replace(minute=0, second=0) for r in self.data]
-        return result
+        # Creation hour of each registrant, grouped by hour
+        return list(self.hourly_buckets().elements())
+
+    def hourly_buckets(self):
+        """ Counter of registrations per hour, keyed by the start of the hour """
+        return Counter(bucket_start(r.dateCreated) for r in self.data)
+
+    def time_series(self, bucket='hour', start=None, end=None, cumulative=False, counts=None):
+        """
+        Registrations per bucket ('hour', 'day' or 'week') as an ordered dict of
+        {bucket start: count}, including empty buckets, from start (default: first
+        registration) up to end (default: now, UTC).
+        With cumulative=True, each value is the running total up to that bucket.
+        counts can be a Counter from hourly_buckets() (or RegistrantSummary.hourly)
+        to re-bucket without going over the registrants again.
+        """
+        if counts is None:
+            counts = self.hourly_buckets()
+        counts = rebucket(counts, bucket)
+        end = end or datetime.datetime.utcnow()
+
+        if start is None:
+            if not counts:
+                return {}
+            start = min(counts)
+        timestamp = bucket_start(start, bucket)
+
+        running = sum(c for t, c in counts.items() if t < timestamp) if cumulative else 0
 
-    def hourly_count(self, start='2020-08-22 13:00'):
         result = {}
-        timestamp = datetime.datetime.strptime(start, '%Y-%m-%d %H:%M')
-        while timestamp < datetime.datetime.utcnow():
-            c = len([r for r in self.data if r.dateCreated.replace(minute=0, second=0) == timestamp])
-            result[timestamp] = c
-            timestamp += datetime.timedelta(hours=1)
+        while timestamp < end:
+            c = counts.get(timestamp, 0)
+            running += c
+            result[timestamp] = running if cumulative else c
+            timestamp += BUCKET_WIDTHS[bucket]
 
         return result
 
+    def hourly_count(self, start='2020-08-22 13:00'):
+        start = datetime.datetime.strptime(start, '%Y-%m-%d %H:%M')
+        return self.time_series('hour', start=start)
+
     def duplicate_registrations(self):
         dupe_ids = Counter(r.oimr_id for r in self.data)
         dupe_ids = [x for x in dupe_ids if dupe_ids[x] > 1]
@@ -86,7 +375,7 @@ class RegistrantList(UserList):
 
     @property
     def country_count(self):
-        return Counter([r.get_path('address.country').get('value') for r in self.data])
+        return Counter([r.country for r in self.data])
 
     @property
     def income(self):
@@ -104,46 +393,95 @@ class RegistrantList(UserList):
 
     @property
     def age_breakdown(self):
-        age_ranges = (
-            (12, 17),
-            (18, 29),
-            (30, 39),
-            (40, 49),
-            (50, 59),
-            (60, 69),
-            (70, 79),
-            (80, 89)
-        )
-
-        def age_to_range(age):
-            if age > 89:
-                return '90+'
-
-            for b, t in age_ranges:
-                if b <= age <= t:
-                    return '{}-{}'.format(b, t)
-
-        result = Counter({'{}-{}'.format(*x): 0 for x in age_ranges})
-        result.update({'80+': 0})
+        result = empty_age_breakdown()
 
         for r in self.data:
             result.update([age_to_range(r.age)])
 
         return result
 
+    def summary(self):
+        """ Gather all report metrics in a single pass over the list """
+        return RegistrantSummary(self.data)
+
+    def columns(self):
+        """ Columnar NumPy copy of the list for vectorized analytics (see columnar.py, needs numpy) """
+        from columnar import RegistrantColumns
+        return RegistrantColumns(self.data)
+
     def print_report(self, include_age=False, include_courses=False, include_qa=False):
+        report = []
+        report.append('Report time: {}'.format(datetime.datetime.now().isoformat()))
+        report.extend(self.summary().report(include_age, include_courses, include_qa))
+
+        for line in report:
+            print(line)
+
+
+class RegistrantSummary():
+    """
+    Aggregate report metrics for a set of registrants.
+    Registrants are fed in one at a time with add(), so the summary can be
+    built in one pass (or alongside another loop) and rendered many times.
+    """
+    def __init__(self, registrants=()):
+        self.entries = 0
+        self.oimr_ids = Counter()
+        self.total = 0.0
+        self.donations = 0.0
+        self.age_min = None
+        self.age_max = None
+        self.age_breakdown = empty_age_breakdown()
+        self.core_courses = Counter({c: 0 for c in courses.COURSES})
+        self.qa_forums = Counter({qa: 0 for qa in courses.list_all_liveQA()})
+        self.countries = Counter()
+        self.hourly = Counter()
+
+        for r in registrants:
+            self.add(r)
+
+    def add(self, r):
+        self.entries += 1
+        self.oimr_ids[r.oimr_id] += 1
+        self.total += r.total
+        self.donations += r.donation
+
+        age = r.age
+        self.age_min = age if self.age_min is None else min(self.age_min, age)
+        self.age_max = age if self.age_max is None else max(self.age_max, age)
+        self.age_breakdown.update([age_to_range(age)])
+
+        if r.core_courses:
+            self.core_courses.update(r.core_courses)
+        if r.qa_forums:
+            self.qa_forums.update(r.qa_forums)
+
+        self.countries.update([r.country])
+        self.hourly[bucket_start(r.dateCreated)] += 1
+
+    @property
+    def unique(self):
+        return len(self.oimr_ids)
+
+    @property
+    def duplicates(self):
+        return self.entries - self.unique
+
+    @property
+    def income(self):
+        return {
+            'registrations': self.total - self.donations,
+            'donations': self.donations,
+            'total': self.total
+        }
+
+    def report(self, include_age=False, include_courses=False, include_qa=False):
+        """ Return the report body (as printed by RegistrantList.print_report) as a list of lines """
         fmt = '{:^8} | {}'
         line_fmt = '{0:-^8} | {0:-^68}'
 
-        counts = (
-            len(self.data),
-            self.registrant_count,
-            len(self.data) - self.registrant_count
-            )
-
         report = []
-        report.append('Report time: {}'.format(datetime.datetime.now().isoformat()))
-        report.append('\nTotal registrants: {} ({} unique, {} duplicates)'.format(*counts))
+        report.append('\nTotal registrants: {} ({} unique, {} duplicates)'.format(self.entries, self.unique, self.duplicates))
 
         # Finance
         report.append('\nFinances\n========')
@@ -152,7 +490,7 @@ class RegistrantList(UserList):
         if include_age:
             # Age
             report.append('\nAge Breakdown\n=============')
-            report.append('Age range: {}-{}\n'.format(min(r.age for r in self.data), max(r.age for r in self.data)))
+            report.append('Age range: {}-{}\n'.format(self.age_min, self.age_max))
             for data in self.age_breakdown.items():
                 report.append('{:6}: {}'.format(*data))
             report.append('\n\n')
@@ -160,11 +498,11 @@ class RegistrantList(UserList):
         if include_courses:
             # Core Courses
             report.append('Core Course Registration\n{}\n'.format('='*24))
-            report.append('Count: {}\n'.format(sum(self.core_course_count().values())))
+            report.append('Count: {}\n'.format(sum(self.core_courses.values())))
 
             report.append(fmt.format('Students', 'Course'))
             report.append(line_fmt.format('-'))
-            for course, count in self.core_course_count().items():
+            for course, count in self.core_courses.items():
                 report.append(fmt.format(count, '({}) '.format(course) + courses.course_title(course)))
 
             report.append('\n\n')
@@ -172,15 +510,14 @@ class RegistrantList(UserList):
         if include_qa:
             # QA Forums
             report.append("QA Forum Signups\n{}\n".format('='*15))
-            report.append('Count: {}\n'.format(sum(self.live_qa_count().values())))
+            report.append('Count: {}\n'.format(sum(self.qa_forums.values())))
 
             report.append(fmt.format('Students', 'Course'))
             report.append(line_fmt.format('-'))
-            for course, count in self.live_qa_count().items():
+            for course, count in self.qa_forums.items():
                 report.append(fmt.format(count, '({}) '.format(course) + courses.course_title(course[:3])))
 
-        for line in report:
-            print(line)
+        return report
 
 
 class Registrant():
@@ -190,13 +527,31 @@ class Registrant():
 
     def __init__(self, raw_data):
         self._raw = raw_data
+
+    @property
+    def _raw(self):
+        return self._raw_data
+
+    @_raw.setter
+    def _raw(self, raw_data):
+        # Replacing the raw data resets everything derived from it
+        self._raw_data = raw_data
+        self.invalidate()
         self.customer_id = self._raw.get('orderCustomerId', '')
         self.registrationId = self._raw.get('displayId', '')
         self.orderNumber = self._raw.get('orderNumber', '')
         self.dateCreated = datetime.datetime.strptime(self._raw.get('dateCreated'), DATE_FMT)
         self.total = float(self._raw.get('total', 0))
 
-    @property
+    def invalidate(self):
+        """
+        Drop cached values. Call this after modifying _raw in place.
+        A RegistrantList holding this registrant won't notice, so call its reset_indexes() too.
+        """
+        self._cache = {}
+        self._field_index = None
+
+    @memoized
     def oimr_id(self):
         """
         Create a hash of the registrant's full name,
@@ -210,45 +565,62 @@ class Registrant():
         return hashed_string
 
 
-    @property
+    @memoized
     def full_name(self):
         fname = self.get_path('name.first').get('value')
         lname = self.get_path('name.last').get('value')
         return ' '.join((fname, lname))
 
-    @property
+    @memoized
     def email_addr(self):
         email = self.get_path('email').get('value')
         return email
 
-    @property
+    @memoized
     def dob(self):
         dob = self.get_path('dateOfBirth').get('value')
         dob_fields = [int(x) for x in dob.split('-')]
         dob = datetime.date(*dob_fields)
         return dob
 
-    @property
+    @memoized
     def age(self):
         age = datetime.date.today() - self.dob
         return age.days // 365
 
-    @property
+    @memoized
     def true_fields(self):
         return [f for f in self._raw['fieldData'] if f.get('value', '').lower() == 'true']
 
     @property
-    def fields(self):
-        # Convert fields to dict for easier use
-        result = {}
-        for f in self._raw['fieldData']:
-            result[f.get('path', f.get('label'))] = f
+    def field_index(self):
+        """
+        Lookup tables for fieldData, built once on first use:
+            'path'   - path -> list of matching fields
+            'label'  - label -> list of matching fields
+            'fields' - path (or label, if no path) -> field
+        """
+        if self._field_index is None:
+            by_path, by_label, fields = {}, {}, {}
+            for f in self._raw['fieldData']:
+                if 'path' in f:
+                    by_path.setdefault(f['path'], []).append(f)
+                if 'label' in f:
+                    by_label.setdefault(f['label'], []).append(f)
+                fields[f.get('path', f.get('label'))] = f
 
-        return result
+            self._field_index = {'path': by_path, 'label': by_label, 'fields': fields}
+
+        return self._field_index
+
+    @property
+    def fields(self):
+        # Dict of fields keyed by path (or label), for easier use
+        return self.field_index['fields']
 
     def get_path(self, path):
-        # Search for path
-        found = [f for f in self._raw['fieldData'] if f.get('path') == path]
+        # Search for path, falling back to a label match
+        found = self.field_index['path'].get(path) or self.field_index['label'].get(path, [])
         if not len(found):
             return None
         elif len(found) == 1:
@@ -256,7 +628,7 @@ class Registrant():
         else:
             return found
 
-    @property
+    @memoized
     def core_courses(self):
         courses = [self.course_regex.search(f.get('label', '')) for f in self.true_fields]
         courses = [m.group(1) for m in courses if m] or None
@@ -266,6 +638,12 @@ class Registrant():
     def extras(self):
         return bool(self.get_path('extras.session1'))
 
+    @property
+    def country(self):
+        # Not every registration has an address, so this can be None
+        country = self.get_path('address.country')
+        return country.get('value') if isinstance(country, dict) else None
+
     @property
     def qa_forums(self):
         return self._qa_forums()
@@ -289,9 +667,13 @@ class Registrant():
     def pprint(self):
         print(self.pretty)
 
-    def _qa_forums(self, type_filter=False):
+    @memoized
+    def _all_qa_forums(self):
         fora = [self.qa_regex.search(f.get('label', '')) for f in self.true_fields]
-        fora = [m.group(1) for m in fora if m] or None
+        return [m.group(1) for m in fora if m] or None
+
+    def _qa_forums(self, type_filter=False):
+        fora = self._all_qa_forums
         if type_filter and fora:
             fora = [x for x in fora if x[3].lower() == type_filter.lower()]
         return fora
@@ -303,10 +685,75 @@ class Registrant():
         return 'Registrant: {0}'.format(self.full_name)
 
 
+class CompactRegistrant():
+    """
+    Memory-light copy of a Registrant: just the values the bridge and reports
+    use, in __slots__, with the raw JSON zlib-compressed. _raw, get_path() and
+    fields rehydrate the raw data on demand, so they're slower than on Registrant.
+    """
+    __slots__ = (
+        'customer_id', 'registrationId', 'orderNumber', 'dateCreated', 'total', 'status',
+        'full_name', 'email_addr', 'dob', 'oimr_id', 'core_courses', 'extras', 'donation',
+        'country', '_all_qa_forums', '_raw_blob'
+    )
+
+    def __init__(self, registrant):
+        for attr in self.__slots__[:-1]:
+            setattr(self, attr, getattr(registrant, attr))
+        self._raw_blob = zlib.compress(json.dumps(registrant._raw).encode())
+
+    @classmethod
+    def from_raw(cls, raw_data):
+        return cls(Registrant(raw_data))
+
+    @property
+    def _raw(self):
+        return json.loads(zlib.decompress(self._raw_blob))
+
+    @property
+    def age(self):
+        age = datetime.date.today() - self.dob
+        return age.days // 365
+
+    @property
+    def qa_forums(self):
+        return self._all_qa_forums
+
+    def _qa_forums(self, type_filter=False):
+        return Registrant._qa_forums(self, type_filter)
+
+    def rehydrate(self):
+        """ Full Registrant for this entry """
+        return Registrant(self._raw)
+
+    def get_path(self, path):
+        return self.rehydrate().get_path(path)
+
+    @property
+    def fields(self):
+        return self.rehydrate().fields
+
+    @property
+    def pretty(self):
+        return json.dumps(self._raw, indent=2, ensure_ascii=False)
+
+    def pprint(self):
+        print(self.pretty)
+
+    def __repr__(self):
+        return '<Registrant {0} ({1})>'.format(self.registrationId, self.full_name)
+
+    def __str__(self):
+        return 'Registrant: {0}'.format(self.full_name)
+
+
 class RegFoxAPI():
-    def __init__(self, inputFile=None, apiKey=None, formId=None):
+    def __init__(self, inputFile=None, apiKey=None, formId=None, retries=3, backoff_factor=0.5, cache=None):
         """ If an inputFile is passed, use that,
-            otherwise, look for explicit values """
+            otherwise, look for explicit values
+            Failed requests (connection errors, 429 and 5xx) are retried up to
+            $retries times, waiting backoff_factor * 2**n seconds between tries
+            Pass a SnapshotCache as $cache to keep fetched pages on disk """
         if inputFile:
             with open(inputFile, 'r') as infile:
                 apiInfo = json.load(infile)
@@ -318,6 +765,20 @@ class RegFoxAPI():
 
         self.product = 'regfox.com'
         self.base_url = 'https://api.webconnex.com/v2/public'
+        self.session = self.make_session(retries, backoff_factor)
+        self.cache = cache
+
+    def make_session(self, retries=3, backoff_factor=0.5):
+        # One keep-alive session, so every page reuses the same connection
+        session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504)
+        )
+        session.mount('https://', HTTPAdapter(max_retries=retry))
+        session.headers.update(self.header)
+        return session
 
     @property
     def params(self):
@@ -342,11 +803,27 @@ class RegFoxAPI():
     def test_connection(self):
         # Just do a fast connection check
         uri = self.base_url + '/ping'
-        r = requests.get(uri, headers=self.header)
+        r = self.session.get(uri)
         return r.status_code == requests.codes.ok
 
     def get_registrants(self, **kwargs):
         """ Fetch a list of all registrants """
+        return list(self.iter_registrants(**kwargs))
+
+    def iter_registrants(self, **kwargs):
+        """ GENERATOR - yield registrants one at a time, fetching pages as needed """
+        for page in self.iter_pages(**kwargs):
+            yield from page
+
+    def iter_pages(self, use_cache=True, force_refresh=False, offline=False, **kwargs):
+        """
+        GENERATOR - yield each page of registrants (a list) as soon as it arrives
+
+        If the API has a cache, a fresh snapshot for the same query is served
+        from disk instead. force_refresh ignores the snapshot, offline only
+        reads the snapshot (FileNotFoundError if there isn't one), and
+        use_cache=False bypasses the cache completely.
+        """
 
         uri = self.base_url + '/search/registrants'
 
@@ -354,30 +831,197 @@ class RegFoxAPI():
         if kwargs:
             params.update(kwargs)
 
-        registrants = []
-
-        r = requests.get(uri, headers=self.header, params=params)
-        if r.status_code != requests.codes.ok:
-            r.raise_for_status()
-
-        # Check to see if we have more to get
-        while r.json().get('hasMore'):
-            #print('getting more...{} of {}'.format(len(r.json()['data']), r.json()['totalResults']))
-            registrants.extend(r.json()['data'])
-            lastObj = r.json()['startingAfter']
-            params.update({'startingAfter': lastObj})
-            r = requests.get(uri, headers=self.header, params=params)
+        cache = self.cache if use_cache else None
+        if offline and cache is None:
+            raise ValueError('offline requires a SnapshotCache')
+
+        if cache:
+            key = cache.key(params)
+            snapshot = cache.load(key)
+            if offline:
+                if snapshot is None:
+                    raise FileNotFoundError('No RegFox snapshot for {}'.format(params))
+                yield from snapshot['pages']
+                return
+            if snapshot and not force_refresh and cache.is_fresh(snapshot):
+                yield from snapshot['pages']
+                return
+
+        # Let RegFox tell us if a stale snapshot is still current. Only for single page
+        # results: with startingAfter paging, an unchanged first page says nothing
+        # about later ones, so multi-page snapshots are always refetched.
+        headers = {}
+        if cache and snapshot and snapshot.get('etag') and len(snapshot['pages']) == 1 and not force_refresh:
+            headers['If-None-Match'] = snapshot['etag']
+
+        pages = []
+        etag = None
+
+        while True:
+            r = self.session.get(uri, params=params, headers=headers)
+            if headers and r.status_code == requests.codes.not_modified:
+                cache.save(key, snapshot['pages'], snapshot['etag'])
+                yield from snapshot['pages']
+                return
             if r.status_code != requests.codes.ok:
                 r.raise_for_status()
 
-        registrants.extend(r.json()['data'])
+            if not pages:
+                etag = r.headers.get('ETag')
+                headers = {}
+
+            page = r.json()
+            if cache:
+                pages.append(page['data'])
+            yield page['data']
+
+            # Check to see if we have more to get
+            if not page.get('hasMore'):
+                break
+            #print('getting more...{} of {}'.format(len(page['data']), page['totalResults']))
+            params.update({'startingAfter': page['startingAfter']})
+
+        if cache:
+            # The ETag only stands for the whole snapshot if there's one page
+            cache.save(key, pages, etag if len(pages) == 1 else None)
+
+    def sync_registrants(self, store, **kwargs):
+        """
+        Fetch only the registrants updated since the store's high-water mark,
+        merge them into the store and save it. Returns the fetched changes;
+        the full list is store.registrants.
+        """
+        changes = []
+        for page in self.iter_sync_pages(store, **kwargs):
+            changes.extend(page)
+
+        return changes
+
+    def iter_sync_pages(self, store, **kwargs):
+        """
+        GENERATOR - yield each page of registrants updated since the store's
+        high-water mark as it arrives, merging it into the store. The store is
+        saved after the last page, so nothing is saved if the fetch fails part way.
+        """
+        since = store.since()
+        if since:
+            kwargs['dateUpdatedAfter'] = since
 
-        return registrants
+        for page in self.iter_pages(use_cache=False, **kwargs):
+            store.merge(page)
+            yield page
 
+        store.save()
 
-def makeRegistrationList(secretFile, **kwargs):
-    api = RegFoxAPI(secretFile)
-    registrants = RegistrantList(api.get_registrants(**kwargs))
+
+class RegistrantStore():
+    """
+    Local JSON copy of every registrant fetched from RegFox, plus the latest
+    dateUpdated seen (the high-water mark), so later runs only need to ask
+    RegFox for what changed.
+    """
+    def __init__(self, path='~/.oimr/regfox_store.json'):
+        self.path = os.path.expanduser(path)
+        self.high_water_mark = None
+        self._registrants = {}
+        self.load()
+
+    @property
+    def registrants(self):
+        """ All stored raw registrants, in the order they were first seen """
+        return list(self._registrants.values())
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'r') as infile:
+            stored = json.load(infile)
+
+        self.high_water_mark = stored.get('highWaterMark')
+        self._registrants = {}
+        self.merge(stored.get('registrants', []))
+
+    def save(self):
+        # Write to a temp file first so a failed run can't leave a half-written store
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump({'highWaterMark': self.high_water_mark, 'registrants': self.registrants}, outfile)
+        os.replace(tmp_path, self.path)
+
+    def merge(self, raw_data):
+        """ Add or replace registrants (keyed by RegFox id) and advance the high-water mark """
+        for d in raw_data:
+            self._registrants[d.get('id', d.get('displayId'))] = d
+            updated = d.get('dateUpdated') or d.get('dateCreated')
+            # DATE_FMT strings sort chronologically
+            if updated and (self.high_water_mark is None or updated > self.high_water_mark):
+                self.high_water_mark = updated
+
+    def since(self):
+        """
+        Value for dateUpdatedAfter, or None if nothing is stored yet.
+        Backs off one second so updates sharing the last timestamp aren't missed;
+        re-fetching a record is harmless since merge() replaces it.
+        """
+        if not self.high_water_mark:
+            return None
+        hwm = datetime.datetime.strptime(self.high_water_mark, DATE_FMT)
+        return (hwm - datetime.timedelta(seconds=1)).strftime(DATE_FMT)
+
+
+class SnapshotCache():
+    """
+    On-disk cache of RegFox responses: one gzipped JSON file per query
+    (formId + params), holding every page, the fetch time and the ETag.
+    Snapshots older than $ttl seconds are refetched (or, for single page
+    results, revalidated via ETag).
+    """
+    def __init__(self, cache_dir='~/.oimr/regfox_cache', ttl=3600):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.ttl = ttl
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, params):
+        params_hash = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        return '{}-{}'.format(params.get('formId'), params_hash)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.json.gz')
+
+    def load(self, key):
+        try:
+            with gzip.open(self.path(key), 'rt', encoding='utf-8') as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            # Missing or unreadable snapshots are just cache misses
+            return None
+
+    def save(self, key, pages, etag=None):
+        snapshot = {
+            'fetched': time.time(),
+            'etag': etag,
+            'pages': pages
+        }
+        tmp_path = self.path(key) + '.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as outfile:
+            json.dump(snapshot, outfile)
+        os.replace(tmp_path, self.path(key))
+
+    def is_fresh(self, snapshot):
+        return time.time() - snapshot['fetched'] < self.ttl
+
+
+def makeRegistrationList(secretFile, cache_dir=None, ttl=3600, offline=False, force_refresh=False, **kwargs):
+    """
+    Fetch registrants and return (api, RegistrantList)
+    With a cache_dir, responses are kept on disk for $ttl seconds; offline=True
+    rebuilds the list from the last snapshot without touching the network.
+    """
+    cache = SnapshotCache(cache_dir, ttl) if cache_dir else None
+    api = RegFoxAPI(secretFile, cache=cache)
+    registrants = RegistrantList.from_stream(api.iter_registrants(offline=offline, force_refresh=force_refresh, **kwargs))
     return api, registrants
 
 if __name__ == '__main__':
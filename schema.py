@@ -0,0 +1,207 @@
+#!/usr/bin/python3.7
+"""
+Versioned schema for the bridge tables
+
+Each migration brings the DB up one version, and the versions applied so far
+are recorded in oimr_schema_version, so migrate() only runs what's new. The
+steps check information_schema before changing anything, so they're safe on a
+DB whose tables were created by hand (or by the scripts in MySql/). That also
+matters because pyAnyConnect connects with raise_on_warnings, which turns the
+notes from CREATE TABLE IF NOT EXISTS on an existing table into errors.
+
+check_indexes() runs EXPLAIN on the hot queries in pyAnyConnect.py and warns
+about any that would scan a whole table.
+
+    python schema.py            # migrate, then check
+    python schema.py --check    # check only
+
+The sekrets table is loaded by hand and isn't managed here.
+"""
+
+import sys
+import logging
+import pyAnyConnect
+
+
+def table_exists(cur, table):
+    cur.execute("""SELECT COUNT(*) FROM information_schema.tables
+                   WHERE table_schema = DATABASE() AND table_name = %s""", (table,))
+    return cur.fetchone()[0] > 0
+
+
+def column_exists(cur, table, column):
+    cur.execute("""SELECT COUNT(*) FROM information_schema.columns
+                   WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s""", (table, column))
+    return cur.fetchone()[0] > 0
+
+
+def index_columns(cur, table):
+    """ {index name: [lowercase columns, in order]} for $table """
+    cur.execute("""SELECT index_name, column_name FROM information_schema.statistics
+                   WHERE table_schema = DATABASE() AND table_name = %s
+                   ORDER BY index_name, seq_in_index""", (table,))
+    result = {}
+    for name, column in cur.fetchall():
+        result.setdefault(name, []).append(column.lower())
+    return result
+
+
+def create_table(cur, table, definition):
+    if not table_exists(cur, table):
+        cur.execute("CREATE TABLE {} ({})".format(table, definition))
+
+
+def add_column(cur, table, column, definition):
+    if not column_exists(cur, table, column):
+        cur.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, definition))
+
+
+def add_index(cur, table, name, columns):
+    """ Add index $name on $columns, unless an index on those columns already exists """
+    if [c.lower() for c in columns] not in index_columns(cur, table).values():
+        cur.execute("ALTER TABLE {} ADD INDEX {} ({})".format(table, name, ', '.join(columns)))
+
+
+def add_primary_key(cur, table, columns):
+    if 'PRIMARY' not in index_columns(cur, table):
+        cur.execute("ALTER TABLE {} ADD PRIMARY KEY ({})".format(table, ', '.join(columns)))
+
+
+def create_tables(cur):
+    create_table(cur, 'oimr_invitations', """
+                     hash              char(32)     NOT NULL,
+                     registrant_Id     varchar(32)  NOT NULL,
+                     registrant_email  varchar(255) NULL,
+                     course_Id         varchar(32)  NOT NULL,
+                     invitation_Id     varchar(64)  NULL,
+                     invitation_status varchar(32)  NULL,
+                     PRIMARY KEY (hash)""")
+    create_table(cur, 'oimr_registrations', """
+                     registrant_id   varchar(32)  NOT NULL,
+                     First_Name      varchar(100) NULL,
+                     Last_Name       varchar(100) NULL,
+                     Email           varchar(255) NULL,
+                     registrant_json mediumtext   NULL,
+                     PRIMARY KEY (registrant_id)""")
+    create_table(cur, 'oimr_logging', """
+                     recno     int          NOT NULL AUTO_INCREMENT,
+                     log_level varchar(24)  NULL,
+                     module    varchar(50)  NULL,
+                     method    varchar(50)  NULL,
+                     line_num  int          NULL,
+                     mess_date datetime     NULL,
+                     message   varchar(500) NULL,
+                     PRIMARY KEY (recno)""")
+
+
+def add_primary_keys(cur):
+    # Tables made before this module may lack them; the upserts rely on them
+    add_primary_key(cur, 'oimr_invitations', ('hash',))
+    add_primary_key(cur, 'oimr_registrations', ('registrant_id',))
+    add_primary_key(cur, 'oimr_logging', ('recno',))
+
+
+def add_registrant_digest(cur):
+    # See bridge.update_registrations()
+    add_column(cur, 'oimr_registrations', 'registrant_digest', 'char(32) NULL')
+
+
+def add_invitation_indexes(cur):
+    add_index(cur, 'oimr_invitations', 'ix_invitations_course', ('course_Id',))
+    add_index(cur, 'oimr_invitations', 'ix_invitations_status', ('invitation_status',))
+    add_index(cur, 'oimr_invitations', 'ix_invitations_registrant_course', ('registrant_Id', 'course_Id'))
+    add_index(cur, 'oimr_invitations', 'ix_invitations_invitation', ('invitation_Id',))
+
+
+# (version, description, step) - append new ones, never edit or reorder applied ones
+MIGRATIONS = [
+    (1, 'create bridge tables', create_tables),
+    (2, 'primary keys', add_primary_keys),
+    (3, 'oimr_registrations.registrant_digest', add_registrant_digest),
+    (4, 'oimr_invitations indexes', add_invitation_indexes),
+]
+
+# Queries pyAnyConnect.PyAnywhereAPI runs on every bridge run, with sample parameters
+HOT_QUERIES = {
+    'get_student_in_course': (
+        "SELECT * FROM oimr_invitations WHERE registrant_Id = %s AND course_Id = %s", ('0', 'commons1')),
+    'get_invitations_for_course': (
+        "SELECT * FROM oimr_invitations WHERE course_Id = %s", ('commons1',)),
+    'get_invitation_hashes': (
+        "SELECT hash FROM oimr_invitations WHERE course_Id IN (%s)", ('commons1',)),
+    # The temporary table it joins against only exists during the call, so check the oimr_invitations side
+    'update_course_invites': (
+        "UPDATE oimr_invitations SET invitation_status = 'ACCEPTED' WHERE invitation_status = 'SENT' AND course_Id IN (%s)",
+        ('commons1',)),
+}
+
+
+def current_version(api):
+    with api.cursor(False) as cur:
+        create_table(cur, 'oimr_schema_version', """
+                         version     int          NOT NULL,
+                         description varchar(100) NULL,
+                         applied     datetime     NOT NULL,
+                         PRIMARY KEY (version)""")
+        cur.execute("SELECT MAX(version) FROM oimr_schema_version")
+        return cur.fetchone()[0] or 0
+
+
+def migrate(api, target=None):
+    """
+    Apply every migration after the DB's current version, up to $target (default: all)
+    Returns the version the DB is at afterwards
+    """
+    version = current_version(api)
+    for number, description, step in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        logging.info('Applying schema migration {}: {}'.format(number, description))
+        # MySQL commits DDL as it goes, so a failed step is just rerun next time
+        with api.cursor(False) as cur:
+            step(cur)
+            cur.execute("INSERT INTO oimr_schema_version (version, description, applied) VALUES (%s, %s, NOW())",
+                        (number, description))
+        version = number
+
+    logging.info('Schema at version {}'.format(version))
+    return version
+
+
+def check_indexes(api, queries=HOT_QUERIES):
+    """
+    EXPLAIN each of $queries and warn about full table scans
+    Returns a list of (query name, table) that would scan the whole table
+    """
+    result = []
+    with api.cursor(True) as cur:
+        # EXPLAIN adds a note (1003) with the rewritten query, which raise_on_warnings
+        # would turn into an error. Turned back on below, as the connection goes back in the pool.
+        cur.execute("SET SESSION sql_notes = 0")
+        for name, (q, val) in queries.items():
+            cur.execute('EXPLAIN ' + q, val)
+            for row in cur.fetchall():
+                if row.get('type') != 'ALL':
+                    continue
+                if row.get('possible_keys'):
+                    # There's an index, the optimizer just thinks the table is too small to bother
+                    logging.debug('{} scans {} but could use {}'.format(name, row.get('table'), row['possible_keys']))
+                    continue
+                logging.warning('{} does a full table scan of {}'.format(name, row.get('table')))
+                result.append((name, row.get('table')))
+        cur.execute("SET SESSION sql_notes = 1")
+
+    return result
+
+
+if __name__ == '__main__':
+    api = pyAnyConnect.get_pyAnywhereAPI()
+    if api.make_mysql_connection(api.gPaTunnel is not None) is None:
+        sys.exit('Unable to connect to the DB')
+    try:
+        if '--check' not in sys.argv:
+            print('Schema at version {}'.format(migrate(api)))
+        for name, table in check_indexes(api):
+            print('WARNING: {} does a full table scan of {}'.format(name, table))
+    finally:
+        api.exit_connections()